@@ -1,12 +1,19 @@
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from app.database import get_db
+from app.cache import redis_client, async_redis_client
+from app.database import after_commit, get_async_db
 from app.models import User
+from app.instrumentation import note_user
+from app.metrics import LOGIN_THROTTLED
+from app.passwords import get_password_hash, verify_password
+from collections import OrderedDict
+import threading
+import time
 import os
 
 # Security configuration
@@ -14,20 +21,21 @@ SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Authenticated users are cached in-process for up to AUTH_CACHE_TTL seconds,
+# which also bounds how long a revoked token can keep working if an
+# invalidation message is missed
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "30"))
+AUTH_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_CACHE_MAX_ENTRIES", "10000"))
+AUTH_INVALIDATION_CHANNEL = "auth:invalidate"
+
+# Failed logins allowed per account and per client IP within LOGIN_ATTEMPT_WINDOW seconds
+LOGIN_MAX_ATTEMPTS_PER_ACCOUNT = int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_ACCOUNT", "5"))
+LOGIN_MAX_ATTEMPTS_PER_IP = int(os.getenv("LOGIN_MAX_ATTEMPTS_PER_IP", "50"))
+LOGIN_ATTEMPT_WINDOW = int(os.getenv("LOGIN_ATTEMPT_WINDOW", "900"))
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash."""
-    return pwd_context.verify(plain_password, hashed_password)
-
-def get_password_hash(password: str) -> str:
-    """Hash a password."""
-    return pwd_context.hash(password)
-
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create a JWT access token."""
     to_encode = data.copy()
@@ -40,29 +48,193 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     return encoded_jwt
 
 def verify_token(token: str, credentials_exception):
-    """Verify and decode a JWT token."""
+    """Verify and decode a JWT token, returning its claims."""
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+        if payload.get("sub") is None:
             raise credentials_exception
-        return email
+        return payload
     except JWTError:
         raise credentials_exception
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    """Get the current authenticated user."""
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
+def create_user_access_token(user: User, expires_delta: Optional[timedelta] = None):
+    """Create an access token carrying the user's id and token version."""
+    return create_access_token(
+        data={"sub": user.email, "uid": user.id, "ver": user.token_version or 0},
+        expires_delta=expires_delta
     )
-    email = verify_token(token, credentials_exception)
-    user = db.query(User).filter(User.email == email).first()
+
+# Authenticated user cache
+class UserCache:
+    """Short-lived, size-bounded cache of authenticated users by id.
+
+    Entries are detached copies of the user row, so they can be used after
+    the request's session is closed. Fields that change often (XP, level)
+    may be up to `ttl` seconds stale; endpoints that report them should load
+    the user themselves.
+    """
+
+    def __init__(self, ttl: float = AUTH_CACHE_TTL, max_entries: int = AUTH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int) -> Optional[User]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, user = entry
+            if expires_at < time.monotonic():
+                del self._entries[user_id]
+                return None
+            return user
+
+    def put(self, user: User):
+        snapshot = User(**{column.name: getattr(user, column.name) for column in User.__table__.c})
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + self.ttl, snapshot)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def discard(self, user_id: int):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+user_cache = UserCache()
+_invalidation_thread = None
+
+def _on_invalidation(message):
+    try:
+        user_cache.discard(int(message["data"]))
+    except (TypeError, ValueError):
+        pass
+
+def start_auth_invalidation():
+    """Drop cached users when any process publishes an invalidation for them."""
+    global _invalidation_thread
+    if _invalidation_thread is not None:
+        return
+    try:
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{AUTH_INVALIDATION_CHANNEL: _on_invalidation})
+        _invalidation_thread = pubsub.run_in_thread(sleep_time=1, daemon=True)
+    except Exception as e:
+        print(f"Error subscribing to auth invalidations, relying on AUTH_CACHE_TTL: {e}")
+
+def stop_auth_invalidation():
+    global _invalidation_thread
+    if _invalidation_thread is not None:
+        _invalidation_thread.stop()
+        _invalidation_thread = None
+
+def invalidate_user(user_id: int):
+    """Drop a user from the auth cache in this and every other process."""
+    user_cache.discard(user_id)
+    try:
+        redis_client.publish(AUTH_INVALIDATION_CHANNEL, str(user_id))
+    except Exception as e:
+        print(f"Error publishing auth invalidation for user {user_id}: {e}")
+
+def revoke_user_tokens(db: Session, user_id: int):
+    """Invalidate every token issued to a user so far."""
+    db.query(User).filter(User.id == user_id).update({User.token_version: User.token_version + 1})
+    db.commit()
+    after_commit(db, invalidate_user, user_id)
+
+def user_from_token(db: Session, token: str) -> Optional[User]:
+    """Resolve the user a token was issued to, or None if it isn't valid.
+
+    Tokens with a user id are served from the auth cache when possible, so
+    most requests authenticate without a database query. The token's
+    version must match the user's, which is how tokens are revoked.
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    user_id = payload.get("uid")
+    if user_id is None:
+        # Tokens issued before ids were added to them
+        if payload.get("sub") is None:
+            return None
+        return db.query(User).filter(User.email == payload["sub"]).first()
+
+    version = payload.get("ver", 0)
+    user = user_cache.get(user_id)
+    if user is None or user.token_version < version:
+        # Not cached, or cached before a revocation this token was issued after
+        user = db.query(User).filter(User.id == user_id).first()
+        if user is None:
+            return None
+        user_cache.put(user)
+    if user.token_version != version:
+        return None
+    return user
+
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)):
+    """Get the current authenticated user."""
+    user = await db.run_sync(user_from_token, token)
     if user is None:
-        raise credentials_exception
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    note_user(user.id)
     return user
 
+# Login throttling
+def _attempt_keys(email: str, ip: str):
+    return (
+        ("account", f"login:failures:account:{email.lower()}", LOGIN_MAX_ATTEMPTS_PER_ACCOUNT),
+        ("ip", f"login:failures:ip:{ip}", LOGIN_MAX_ATTEMPTS_PER_IP),
+    )
+
+async def login_retry_after(email: str, ip: str) -> Optional[int]:
+    """Seconds until a login for this account from this IP may be attempted, or None if allowed.
+
+    Checked before the password is verified, so throttled attempts cost a
+    Redis round trip rather than a bcrypt verification. Fails open if Redis
+    is unavailable.
+    """
+    keys = _attempt_keys(email, ip)
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for _, key, _ in keys:
+            pipe.get(key)
+            pipe.ttl(key)
+        results = await pipe.execute()
+    except Exception as e:
+        print(f"Error checking login attempts: {e}")
+        return None
+    for i, (scope, _, limit) in enumerate(keys):
+        failures, ttl = results[2 * i], results[2 * i + 1]
+        if failures is not None and int(failures) >= limit:
+            LOGIN_THROTTLED.labels(scope=scope).inc()
+            return max(ttl, 1)
+    return None
+
+async def record_login_failure(email: str, ip: str):
+    """Count a failed login against the account and the IP."""
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for _, key, _ in _attempt_keys(email, ip):
+            pipe.incr(key)
+            pipe.expire(key, LOGIN_ATTEMPT_WINDOW, nx=True)
+        await pipe.execute()
+    except Exception as e:
+        print(f"Error recording login failure: {e}")
+
+async def clear_login_failures(email: str):
+    """Reset an account's failure count after a successful login."""
+    try:
+        await async_redis_client.delete(_attempt_keys(email, "")[0][1])
+    except Exception as e:
+        print(f"Error clearing login failures: {e}")
+
 def authenticate_user(db: Session, email: str, password: str):
     """Authenticate a user with email and password."""
     user = db.query(User).filter(User.email == email).first()
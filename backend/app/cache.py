@@ -0,0 +1,38 @@
+import redis
+import redis.asyncio
+import os
+import secrets
+from typing import Optional
+
+# Redis URL from environment variables
+REDIS_URL = os.getenv("REDIS_URL", "redis://redis:6379")
+
+# Shared Redis client for caching, leaderboards and coordination
+redis_client = redis.Redis.from_url(REDIS_URL, db=0, decode_responses=True)
+
+# Async client for use on the event loop
+async_redis_client = redis.asyncio.Redis.from_url(REDIS_URL, db=0, decode_responses=True)
+
+# Deletes a lock only while it still holds the token it was taken with
+RELEASE_LOCK = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_release_lock = redis_client.register_script(RELEASE_LOCK)
+
+def acquire_lock(key: str, ttl_seconds: float) -> Optional[str]:
+    """Take a lock that expires after ttl_seconds. Returns its token, or None if it's held."""
+    token = secrets.token_hex(16)
+    if redis_client.set(key, token, nx=True, px=int(ttl_seconds * 1000)):
+        return token
+    return None
+
+def release_lock(key: str, token: str):
+    """Release a lock taken with acquire_lock.
+
+    If it expired and another worker has taken it since, theirs is left alone.
+    """
+    _release_lock(keys=[key], args=[token])
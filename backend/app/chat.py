@@ -0,0 +1,338 @@
+from fastapi import WebSocket, WebSocketDisconnect, status
+from app.cache import async_redis_client
+from app.metrics import CHAT_CONNECTIONS, CHAT_QUEUED_MESSAGES, CHAT_MESSAGES_DROPPED, CHAT_DISCONNECTS
+from collections import defaultdict
+from datetime import datetime
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Longest chat message accepted, in characters
+CHAT_MAX_MESSAGE_CHARS = int(os.getenv("CHAT_MAX_MESSAGE_CHARS", "2000"))
+
+# Outbound messages buffered per connection, and what happens to a client
+# that falls that far behind: "disconnect" closes it (it can reconnect and
+# catch up), "drop" discards its oldest queued message
+CHAT_SEND_QUEUE_SIZE = int(os.getenv("CHAT_SEND_QUEUE_SIZE", "256"))
+CHAT_SLOW_CONSUMER_POLICY = os.getenv("CHAT_SLOW_CONSUMER_POLICY", "disconnect")
+# Seconds a single send may take before the connection is considered stalled
+CHAT_SEND_TIMEOUT = float(os.getenv("CHAT_SEND_TIMEOUT", "10"))
+
+# Clients are pinged every CHAT_HEARTBEAT_INTERVAL seconds and closed once
+# nothing has been heard from them for CHAT_IDLE_TIMEOUT seconds
+CHAT_HEARTBEAT_INTERVAL = float(os.getenv("CHAT_HEARTBEAT_INTERVAL", "25"))
+CHAT_IDLE_TIMEOUT = float(os.getenv("CHAT_IDLE_TIMEOUT", "60"))
+
+# Each guild keeps roughly its last CHAT_HISTORY_MAX messages in a Redis
+# stream; a reconnecting client is sent at most CHAT_RESUME_MAX of them
+CHAT_HISTORY_MAX = int(os.getenv("CHAT_HISTORY_MAX", "1000"))
+CHAT_RESUME_MAX = int(os.getenv("CHAT_RESUME_MAX", "200"))
+
+PING = json.dumps({"type": "ping"})
+
+# Appends a message to the guild's stream and publishes it with its stream id
+# in one step, so live messages reach every process in history order
+APPEND_AND_PUBLISH = """
+local id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[1], '*', 'data', ARGV[2])
+redis.call('PUBLISH', ARGV[3], '{"id": "' .. id .. '", ' .. string.sub(ARGV[2], 2))
+return id
+"""
+ID_PREFIX = '{"id": "'
+STREAM_ID = re.compile(r"^\d+-\d+$")
+
+def room_channel(guild_id: int) -> str:
+    """Redis pub/sub channel carrying a guild's chat."""
+    return f"guild:{guild_id}:chat"
+
+def history_key(guild_id: int) -> str:
+    """Redis stream holding a guild's recent chat."""
+    return f"guild:{guild_id}:chat:log"
+
+def stream_position(entry_id: str) -> Tuple[int, int]:
+    """Order of a Redis stream id ("<ms>-<seq>")."""
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+def payload_id(payload: str) -> Optional[str]:
+    """Stream id of a published message payload, if it has one."""
+    if not payload.startswith(ID_PREFIX):
+        return None
+    return payload[len(ID_PREFIX):payload.index('"', len(ID_PREFIX))]
+
+def entry_payload(entry_id: str, fields: Dict[str, str]) -> str:
+    """Payload for a stored message, as it was published."""
+    return ID_PREFIX + entry_id + '", ' + fields["data"][1:]
+
+class ChatConnection:
+    """A chat socket with its own bounded outbound queue and writer task.
+
+    Messages are queued without waiting, so one slow client never delays
+    delivery to the rest of its room.
+    """
+
+    def __init__(self, hub: "ChatHub", guild_id: int, websocket: WebSocket, queue_size: int = CHAT_SEND_QUEUE_SIZE):
+        self.hub = hub
+        self.guild_id = guild_id
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.last_seen = time.monotonic()
+        self.closed = False
+        # Live messages held back while missed history is replayed
+        self._held: Optional[List[str]] = None
+        self._writer = asyncio.create_task(self._write())
+        # Referenced so the loop can't collect it before it runs
+        self._closing: Optional[asyncio.Task] = None
+
+    def touch(self):
+        """Record that the client is alive."""
+        self.last_seen = time.monotonic()
+
+    def offer(self, payload: str):
+        """Queue a payload for the client, applying the slow-consumer policy if it's full."""
+        if self.closed:
+            return
+        if self._held is not None:
+            self._held.append(payload)
+            return
+        if self.queue.full():
+            if CHAT_SLOW_CONSUMER_POLICY != "drop":
+                CHAT_MESSAGES_DROPPED.labels(reason="slow_consumer").inc(self.queue.qsize() + 1)
+                self.close("slow_consumer", status.WS_1013_TRY_AGAIN_LATER)
+                return
+            self.queue.get_nowait()
+            CHAT_QUEUED_MESSAGES.dec()
+            CHAT_MESSAGES_DROPPED.labels(reason="queue_full").inc()
+        self.queue.put_nowait(payload)
+        CHAT_QUEUED_MESSAGES.inc()
+
+    def hold(self):
+        """Hold live messages until release(), while history is replayed."""
+        self._held = []
+
+    def release(self, replayed: List[str], replayed_until: Optional[str]):
+        """Send the replayed messages, then the held live ones the replay didn't cover."""
+        held, self._held = self._held or [], None
+        for payload in replayed:
+            self.offer(payload)
+        cutoff = stream_position(replayed_until) if replayed_until else None
+        for payload in held:
+            entry_id = payload_id(payload)
+            if cutoff and entry_id and stream_position(entry_id) <= cutoff:
+                continue
+            self.offer(payload)
+
+    async def _write(self):
+        while True:
+            payload = await self.queue.get()
+            CHAT_QUEUED_MESSAGES.dec()
+            try:
+                await asyncio.wait_for(self.websocket.send_text(payload), timeout=CHAT_SEND_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.close("send_timeout")
+                return
+            except Exception:
+                self.close("error")
+                return
+
+    def close(self, reason: str, code: int = status.WS_1001_GOING_AWAY):
+        """Stop writing to the client, close its socket and leave its room."""
+        if self.closed:
+            return
+        self.closed = True
+        CHAT_DISCONNECTS.labels(reason=reason).inc()
+        CHAT_QUEUED_MESSAGES.dec(self.queue.qsize())
+        if self._writer is not asyncio.current_task():
+            self._writer.cancel()
+        self._closing = asyncio.create_task(self._shutdown(code))
+
+    async def _shutdown(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+        try:
+            await self.hub.leave(self)
+        except Exception as e:
+            print(f"Error leaving guild {self.guild_id} chat: {e}")
+
+class ChatHub:
+    """Guild chat rooms for the sockets connected to this process.
+
+    Messages are published to the guild's Redis channel and every process
+    subscribed to it delivers them to its local sockets, so chat works
+    across workers. A process only subscribes to rooms it has sockets in,
+    and a message is only queued for the sockets in its room.
+    """
+
+    def __init__(self, redis=async_redis_client, persist: bool = True):
+        self.redis = redis
+        self._append = redis.register_script(APPEND_AND_PUBLISH) if persist else None
+        self.rooms: Dict[int, Set[ChatConnection]] = defaultdict(set)
+        self._pubsub = None
+        # Serializes (un)subscribes; concurrent first subscribes would each open a connection
+        self._subscription_lock = asyncio.Lock()
+        self._listener: Optional[asyncio.Task] = None
+        self._reaper: Optional[asyncio.Task] = None
+
+    async def join(self, guild_id: int, websocket: WebSocket, last_id: Optional[str] = None) -> ChatConnection:
+        """Add an accepted socket to a guild's room.
+
+        With `last_id` (the stream id of the last message the client saw),
+        the messages it missed are sent before live ones.
+        """
+        connection = ChatConnection(self, guild_id, websocket)
+        if last_id and self._append:
+            connection.hold()
+        room = self.rooms[guild_id]
+        room.add(connection)
+        CHAT_CONNECTIONS.inc()
+        if len(room) == 1:
+            await self._subscribe(guild_id)
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._heartbeat())
+        if last_id and self._append:
+            await self._replay(connection, last_id)
+        return connection
+
+    async def _replay(self, connection: ChatConnection, last_id: str):
+        replayed, replayed_until = [], None
+        try:
+            entries = await self.redis.xrevrange(
+                history_key(connection.guild_id), max="+", min=f"({last_id}", count=CHAT_RESUME_MAX
+            )
+            entries.reverse()
+            if len(entries) == CHAT_RESUME_MAX:
+                # Older missed messages are left to the history endpoint
+                replayed.append(json.dumps({"type": "history_gap", "before": entries[0][0]}))
+            replayed.extend(entry_payload(entry_id, fields) for entry_id, fields in entries)
+            if entries:
+                replayed_until = entries[-1][0]
+        except Exception as e:
+            print(f"Error replaying guild {connection.guild_id} chat: {e}")
+        connection.release(replayed, replayed_until)
+
+    async def history(self, guild_id: int, before: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """A page of a guild's stored chat, oldest first, ending just before `before`."""
+        entries = await self.redis.xrevrange(
+            history_key(guild_id), max=f"({before}" if before else "+", min="-", count=limit
+        )
+        return [json.loads(entry_payload(entry_id, fields)) for entry_id, fields in reversed(entries)]
+
+    async def leave(self, connection: ChatConnection):
+        """Remove a connection from its room."""
+        room = self.rooms.get(connection.guild_id)
+        if room is None or connection not in room:
+            return
+        room.discard(connection)
+        CHAT_CONNECTIONS.dec()
+        if not connection.closed:
+            connection.close("client")
+        if not room:
+            del self.rooms[connection.guild_id]
+            await self._unsubscribe(connection.guild_id)
+
+    async def publish(self, guild_id: int, message: Dict[str, Any]):
+        """Send a message to everyone in a guild's room, on every process."""
+        payload = json.dumps(message)
+        try:
+            if self._append:
+                await self._append(keys=[history_key(guild_id)], args=[CHAT_HISTORY_MAX, payload, room_channel(guild_id)])
+            else:
+                await self.redis.publish(room_channel(guild_id), payload)
+        except Exception as e:
+            # Without Redis, at least reach the sockets on this process
+            print(f"Error publishing guild {guild_id} chat message: {e}")
+            self.deliver(guild_id, payload)
+
+    def deliver(self, guild_id: int, payload: str):
+        """Queue a payload for this process's sockets in a guild's room."""
+        for connection in list(self.rooms.get(guild_id, ())):
+            connection.offer(payload)
+
+    async def _heartbeat(self):
+        while self.rooms:
+            await asyncio.sleep(CHAT_HEARTBEAT_INTERVAL)
+            deadline = time.monotonic() - CHAT_IDLE_TIMEOUT
+            for room in list(self.rooms.values()):
+                for connection in list(room):
+                    if connection.last_seen < deadline:
+                        connection.close("idle")
+                    else:
+                        connection.offer(PING)
+
+    async def _subscribe(self, guild_id: int):
+        async with self._subscription_lock:
+            try:
+                if self._pubsub is None:
+                    self._pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                await self._pubsub.subscribe(room_channel(guild_id))
+                if self._listener is None or self._listener.done():
+                    self._listener = asyncio.create_task(self._listen())
+            except Exception as e:
+                print(f"Error subscribing to guild {guild_id} chat: {e}")
+
+    async def _unsubscribe(self, guild_id: int):
+        async with self._subscription_lock:
+            try:
+                if self._pubsub is not None and guild_id not in self.rooms:
+                    await self._pubsub.unsubscribe(room_channel(guild_id))
+            except Exception as e:
+                print(f"Error unsubscribing from guild {guild_id} chat: {e}")
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Guild chat subscription error: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            guild_id = int(message["channel"].split(":")[1])
+            self.deliver(guild_id, message["data"])
+
+    async def close(self):
+        """Stop listening for chat messages."""
+        for task in (self._listener, self._reaper):
+            if task is not None:
+                task.cancel()
+        self._listener = self._reaper = None
+        if self._pubsub is not None:
+            await self._pubsub.close()
+            self._pubsub = None
+
+def chat_message(user, text: str) -> Dict[str, Any]:
+    """Build the chat message a user sends, as delivered to the room."""
+    return {
+        "type": "message",
+        "user_id": user.id,
+        "user": user.adventurer_name,
+        "message": text[:CHAT_MAX_MESSAGE_CHARS],
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+async def serve_chat(hub: ChatHub, websocket: WebSocket, guild_id: int, user, last_id: Optional[str] = None):
+    """Accept an authorized socket into a guild's room and relay its messages until it closes."""
+    await websocket.accept()
+    connection = await hub.join(guild_id, websocket, last_id)
+    try:
+        while True:
+            data = json.loads(await websocket.receive_text())
+            # Any message, including the {"type": "pong"} reply to a ping, shows the client is alive
+            connection.touch()
+            text = data.get("message") if isinstance(data, dict) else None
+            if isinstance(text, str) and text.strip():
+                await hub.publish(guild_id, chat_message(user, text))
+    except (WebSocketDisconnect, RuntimeError, ValueError):
+        # RuntimeError: the hub already closed the socket (slow or idle client)
+        pass
+    finally:
+        await hub.leave(connection)
+
+chat_hub = ChatHub()
@@ -1,22 +1,48 @@
+from sqlalchemy import BigInteger, DateTime, Integer, and_, cast, column, func, insert, literal, literal_column, select, tuple_, update, values
+from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
-from app.models import User, Quest, Avatar, Friendship, Guild, GuildMember, GuildQuest, HeroPass, UserInventory
+from app.models import User, Quest, Avatar, Friendship, FriendEdge, Guild, GuildMember, GuildQuest, HeroPass, UserInventory, XPEvent
 from app.schemas import UserCreate, QuestCreate, AvatarCreate, GuildCreate, GuildQuestCreate
-from app.auth import get_password_hash
+from app.passwords import get_password_hash
+from app.database import after_commit
+from app import leaderboard
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
+import base64
+import bisect
+
+# Level curve: each level needs int(LEVEL_GROWTH times) the XP of the one
+# before, starting at LEVEL_BASE_XP for level 1 -> 2
+LEVEL_BASE_XP = 100
+LEVEL_GROWTH = 1.5
+# Largest lifetime XP users.total_xp can hold
+MAX_TOTAL_XP = 2**31 - 1
+
+def _level_floors() -> List[int]:
+    floors, floor, step = [0], 0, LEVEL_BASE_XP
+    while floor <= MAX_TOTAL_XP:
+        floor, step = floor + step, int(step * LEVEL_GROWTH)
+        floors.append(floor)
+    return floors
+
+# Lifetime XP needed to reach each level (index 0 is level 1), up to the
+# first level out of reach, so every total has a level and a next one
+LEVEL_FLOORS = _level_floors()
+_LEVEL_FLOORS_SQL = literal_column(f"(ARRAY[{', '.join(map(str, LEVEL_FLOORS))}]::bigint[])", ARRAY(BigInteger))
 
 # User CRUD operations
-def create_user(db: Session, user: UserCreate):
-    """Create a new user."""
-    hashed_password = get_password_hash(user.password)
+def create_user(db: Session, user: UserCreate, password_hash: Optional[str] = None):
+    """Create a new user, hashing their password unless the hash is given."""
     db_user = User(
         email=user.email,
-        password_hash=hashed_password,
+        password_hash=password_hash or get_password_hash(user.password),
         adventurer_name=user.adventurer_name
     )
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    after_commit(db, leaderboard.record_score, db_user)
     return db_user
 
 def get_user_by_email(db: Session, email: str):
@@ -27,22 +53,56 @@ def get_user_by_id(db: Session, user_id: int):
     """Get user by ID."""
     return db.query(User).filter(User.id == user_id).first()
 
-def update_user_xp(db: Session, user_id: int, xp_gained: int):
-    """Update user XP and check for level up."""
-    user = get_user_by_id(db, user_id)
+# Level math is a lookup in LEVEL_FLOORS over lifetime XP, so a level-up of
+# any size is one expression, in Python or in SQL, and exact in both
+def xp_to_reach_level(level: int) -> int:
+    """Lifetime XP needed to reach a level."""
+    return LEVEL_FLOORS[level - 1]
+
+def level_for_total_xp(total_xp: int) -> int:
+    """Level reached with a given amount of lifetime XP."""
+    return bisect.bisect_right(LEVEL_FLOORS, total_xp)
+
+def _xp_to_reach_level_sql(level):
+    # Postgres arrays are 1-based, so level n is element n
+    return _LEVEL_FLOORS_SQL[level]
+
+def _level_for_total_xp_sql(total_xp):
+    # width_bucket counts the floors at or below the total
+    return func.width_bucket(cast(total_xp, BigInteger), _LEVEL_FLOORS_SQL)
+
+def _progress_values(total_xp):
+    """Column values for a user whose lifetime XP becomes `total_xp` (a SQL expression)."""
+    level = _level_for_total_xp_sql(total_xp)
+    level_floor = _xp_to_reach_level_sql(level)
+    return {
+        "total_xp": total_xp,
+        "level": level,
+        "xp": total_xp - level_floor,
+        "xp_for_next_level": _xp_to_reach_level_sql(level + 1) - level_floor
+    }
+
+def update_user_xp(db: Session, user_id: int, xp_gained: int, source: str = "quest", source_id: Optional[int] = None):
+    """Award XP, record the grant in the XP ledger and apply any level up.
+
+    XP is added with a single atomic UPDATE ... RETURNING, so concurrent
+    grants can't overwrite each other.
+    """
+    user = db.scalars(
+        update(User)
+        .where(User.id == user_id)
+        .values(**_progress_values(func.coalesce(User.total_xp, 0) + xp_gained))
+        .returning(User),
+        execution_options={"populate_existing": True}
+    ).one_or_none()
     if not user:
         return None
     
-    user.xp += xp_gained
-    
-    # Check for level up
-    while user.xp >= user.xp_for_next_level:
-        user.level += 1
-        user.xp -= user.xp_for_next_level
-        user.xp_for_next_level = int(user.xp_for_next_level * 1.5)
-    
+    event = XPEvent(user_id=user_id, amount=xp_gained, source=source, source_id=source_id, created_at=datetime.utcnow())
+    db.add(event)
     db.commit()
-    db.refresh(user)
+    after_commit(db, leaderboard.record_score, user, xp_gained)
+    after_commit(db, leaderboard.record_xp_event, user_id, xp_gained, event.created_at)
     return user
 
 # Quest CRUD operations
@@ -54,30 +114,192 @@ def create_quest(db: Session, quest: QuestCreate, user_id: int):
     db.refresh(db_quest)
     return db_quest
 
-def get_user_quests(db: Session, user_id: int, skip: int = 0, limit: int = 100):
-    """Get all quests for a user."""
-    return db.query(Quest).filter(Quest.user_id == user_id).offset(skip).limit(limit).all()
+def encode_quest_cursor(quest: Quest) -> str:
+    """Opaque cursor pointing just past a quest in a quest list."""
+    return base64.urlsafe_b64encode(f"{quest.created_at.isoformat()}|{quest.id}".encode()).decode()
+
+def decode_quest_cursor(cursor: str):
+    """Return the (created_at, id) position in a cursor; raises ValueError if malformed."""
+    try:
+        created_at, quest_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(quest_id)
+    except Exception:
+        raise ValueError("Invalid quest cursor")
+
+def get_user_quests(db: Session, user_id: int, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, status: Optional[str] = None):
+    """Get a user's quests, newest first.
+
+    Pass the cursor of the last quest on a page (encode_quest_cursor) to get
+    the next one. The cursor is a keyset position on (created_at, id), so
+    every page is an index range scan no matter how deep it is. `skip` is
+    kept for older clients and gets slower the further it skips.
+    `status` is "active" or "completed" to filter the list.
+    """
+    query = db.query(Quest).filter(Quest.user_id == user_id)
+    if status == "active":
+        query = query.filter(Quest.is_completed.is_(False))
+    elif status == "completed":
+        query = query.filter(Quest.is_completed.is_(True))
+    if cursor:
+        query = query.filter(tuple_(Quest.created_at, Quest.id) < decode_quest_cursor(cursor))
+    query = query.order_by(Quest.created_at.desc(), Quest.id.desc())
+    if skip:
+        query = query.offset(skip)
+    return query.limit(limit).all()
 
 def get_quest_by_id(db: Session, quest_id: int):
     """Get quest by ID."""
     return db.query(Quest).filter(Quest.id == quest_id).first()
 
 def complete_quest(db: Session, quest_id: int, user_id: int):
-    """Complete a quest and award XP."""
-    quest = get_quest_by_id(db, quest_id)
-    if not quest or quest.user_id != user_id or quest.is_completed:
+    """Complete a quest and award XP in one statement.
+
+    The quest is only updated while it is still uncompleted. The user's XP
+    update and the ledger entry are chained onto it as data-modifying CTEs,
+    so completion is one round trip plus the commit. Concurrent completions
+    of the same quest serialize on the quest row, and only the first one
+    matches and awards XP.
+    """
+    now = datetime.utcnow()
+    done = (
+        update(Quest)
+        .where(Quest.id == quest_id, Quest.user_id == user_id, Quest.is_completed.is_(False))
+        .values(is_completed=True, completed_at=now)
+        .returning(*Quest.__table__.c)
+        .cte("done")
+    )
+    awarded = (
+        update(User)
+        .where(User.id == done.c.user_id)
+        .values(**_progress_values(func.coalesce(User.total_xp, 0) + done.c.xp_value))
+        .returning(User.id, User.adventurer_name, User.level, User.xp, User.xp_for_next_level, User.total_xp)
+        .cte("awarded")
+    )
+    ledger = (
+        insert(XPEvent)
+        .from_select(
+            ["user_id", "amount", "source", "source_id", "created_at"],
+            select(done.c.user_id, done.c.xp_value, literal("quest"), done.c.id, literal(now))
+        )
+        .returning(XPEvent.id)
+        .cte("ledger")
+    )
+    row = db.execute(
+        select(
+            *done.c,
+            awarded.c.adventurer_name,
+            awarded.c.level,
+            awarded.c.xp,
+            awarded.c.xp_for_next_level,
+            awarded.c.total_xp
+        )
+        .select_from(done.join(awarded, awarded.c.id == done.c.user_id))
+        .add_cte(ledger)
+    ).one_or_none()
+    db.commit()
+    if row is None:
         return None
     
-    quest.is_completed = True
-    quest.completed_at = datetime.utcnow()
-    
-    # Award XP to user
-    user = update_user_xp(db, user_id, quest.xp_value)
-    
-    db.commit()
-    db.refresh(quest)
+    quest = Quest(**{column.name: getattr(row, column.name) for column in Quest.__table__.c})
+    user = User(
+        id=user_id,
+        adventurer_name=row.adventurer_name,
+        level=row.level,
+        xp=row.xp,
+        xp_for_next_level=row.xp_for_next_level,
+        total_xp=row.total_xp
+    )
+    after_commit(db, leaderboard.record_score, user, quest.xp_value)
+    after_commit(db, leaderboard.record_xp_event, user_id, quest.xp_value, now)
     return quest
 
+def create_quests(db: Session, quests: List[QuestCreate], user_id: int):
+    """Create several quests for a user with one INSERT and one commit."""
+    rows = db.execute(
+        insert(Quest).returning(*Quest.__table__.c, sort_by_parameter_order=True),
+        [{**quest.dict(), "user_id": user_id} for quest in quests]
+    ).all()
+    db.commit()
+    # Built from the returned rows, so reading them doesn't reload each quest
+    return [Quest(**row._mapping) for row in rows]
+
+def complete_quests(db: Session, quest_ids: List[int], user_id: int):
+    """Complete several quests in one transaction and award their XP together.
+
+    Works like complete_quest, but the user's XP and level are updated once
+    with the sum of every quest that was completed. Returns the completed
+    quests by id, the quest ids that exist but were already completed, and
+    the updated user (None if nothing was completed).
+    """
+    quest_ids = list(dict.fromkeys(quest_ids))
+    now = datetime.utcnow()
+    done = (
+        update(Quest)
+        .where(Quest.id.in_(quest_ids), Quest.user_id == user_id, Quest.is_completed.is_(False))
+        .values(is_completed=True, completed_at=now)
+        .returning(*Quest.__table__.c)
+        .cte("done")
+    )
+    gained = select(func.coalesce(func.sum(done.c.xp_value), 0)).scalar_subquery()
+    awarded = (
+        update(User)
+        .where(User.id == user_id, select(done.c.id).exists())
+        .values(**_progress_values(func.coalesce(User.total_xp, 0) + gained))
+        .returning(User.id, User.adventurer_name, User.level, User.xp, User.xp_for_next_level, User.total_xp, User.last_interaction_mood)
+        .cte("awarded")
+    )
+    ledger = (
+        insert(XPEvent)
+        .from_select(
+            ["user_id", "amount", "source", "source_id", "created_at"],
+            select(done.c.user_id, done.c.xp_value, literal("quest"), done.c.id, literal(now))
+        )
+        .returning(XPEvent.id)
+        .cte("ledger")
+    )
+    rows = db.execute(
+        select(
+            *done.c,
+            awarded.c.adventurer_name,
+            awarded.c.level,
+            awarded.c.xp,
+            awarded.c.xp_for_next_level,
+            awarded.c.total_xp,
+            awarded.c.last_interaction_mood
+        )
+        .select_from(done.join(awarded, awarded.c.id == done.c.user_id))
+        .add_cte(ledger)
+    ).all()
+
+    completed = {
+        row.id: Quest(**{column.name: getattr(row, column.name) for column in Quest.__table__.c})
+        for row in rows
+    }
+    missing = [quest_id for quest_id in quest_ids if quest_id not in completed]
+    already_completed = set()
+    if missing:
+        already_completed = set(db.scalars(
+            select(Quest.id).where(Quest.id.in_(missing), Quest.user_id == user_id)
+        ))
+    db.commit()
+    if not rows:
+        return completed, already_completed, None
+
+    row = rows[0]
+    user = User(
+        id=user_id,
+        adventurer_name=row.adventurer_name,
+        level=row.level,
+        xp=row.xp,
+        xp_for_next_level=row.xp_for_next_level,
+        total_xp=row.total_xp,
+        last_interaction_mood=row.last_interaction_mood
+    )
+    xp_gained = sum(quest.xp_value for quest in completed.values())
+    after_commit(db, leaderboard.record_score, user, xp_gained)
+    after_commit(db, leaderboard.record_xp_event, user_id, xp_gained, now)
+    return completed, already_completed, user
+
 # Avatar CRUD operations
 def create_avatar(db: Session, avatar: AvatarCreate, user_id: int):
     """Create or update user avatar."""
@@ -100,44 +322,116 @@ def get_user_avatar(db: Session, user_id: int):
     return db.query(Avatar).filter(Avatar.user_id == user_id).first()
 
 # Friendship CRUD operations
+def _friendship_pair(user_a, user_b):
+    """The (lower id, higher id) pair uq_friendships_pair indexes a friendship by."""
+    return func.least(user_a, user_b), func.greatest(user_a, user_b)
+
 def create_friendship_request(db: Session, user_one_id: int, user_two_id: int):
-    """Create a friendship request."""
-    # Check if friendship already exists
-    existing = db.query(Friendship).filter(
-        ((Friendship.user_one_id == user_one_id) & (Friendship.user_two_id == user_two_id)) |
-        ((Friendship.user_one_id == user_two_id) & (Friendship.user_two_id == user_one_id))
-    ).first()
-    
-    if existing:
-        return existing
-    
-    db_friendship = Friendship(
-        user_one_id=user_one_id,
-        user_two_id=user_two_id,
-        action_user_id=user_one_id
+    """Create a friendship request, or return the one already between the two users.
+
+    Concurrent requests between the same users, in either direction, resolve
+    to one row through the unique pair index.
+    """
+    if user_one_id == user_two_id:
+        return None
+    db.execute(
+        pg_insert(Friendship)
+        .values(user_one_id=user_one_id, user_two_id=user_two_id, action_user_id=user_one_id,
+                status="pending", created_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=list(_friendship_pair(Friendship.user_one_id, Friendship.user_two_id)))
     )
-    db.add(db_friendship)
     db.commit()
-    db.refresh(db_friendship)
-    return db_friendship
+    low, high = min(user_one_id, user_two_id), max(user_one_id, user_two_id)
+    return db.query(Friendship).filter(
+        tuple_(*_friendship_pair(Friendship.user_one_id, Friendship.user_two_id)) == (low, high)
+    ).first()
 
 def accept_friendship(db: Session, friendship_id: int, user_id: int):
-    """Accept a friendship request."""
+    """Accept a friendship request and add the friend edges both ways."""
     friendship = db.query(Friendship).filter(Friendship.id == friendship_id).first()
     if not friendship or friendship.user_two_id != user_id:
         return None
     
     friendship.status = "accepted"
     friendship.action_user_id = user_id
+    now = datetime.utcnow()
+    db.execute(
+        pg_insert(FriendEdge)
+        .values([
+            {"user_id": friendship.user_one_id, "friend_id": friendship.user_two_id, "created_at": now},
+            {"user_id": friendship.user_two_id, "friend_id": friendship.user_one_id, "created_at": now},
+        ])
+        .on_conflict_do_nothing()
+    )
     db.commit()
     db.refresh(friendship)
+    after_commit(db, leaderboard.record_friendship, friendship.user_one_id, friendship.user_two_id)
     return friendship
 
 def get_user_friendships(db: Session, user_id: int):
-    """Get all friendships for a user."""
-    return db.query(Friendship).filter(
-        ((Friendship.user_one_id == user_id) | (Friendship.user_two_id == user_id)) &
-        (Friendship.status == "accepted")
+    """Get all accepted friendships for a user."""
+    return db.query(Friendship).join(
+        FriendEdge,
+        and_(
+            FriendEdge.user_id == user_id,
+            tuple_(*_friendship_pair(Friendship.user_one_id, Friendship.user_two_id))
+            == tuple_(*_friendship_pair(FriendEdge.user_id, FriendEdge.friend_id))
+        )
+    ).filter(Friendship.status == "accepted").all()
+
+def get_friends(db: Session, user_id: int, limit: int = 100):
+    """Get a user's friends, most recent friendships first, as (user, friends since) rows."""
+    return db.query(User, FriendEdge.created_at).join(
+        FriendEdge, FriendEdge.friend_id == User.id
+    ).filter(FriendEdge.user_id == user_id).order_by(FriendEdge.created_at.desc(), User.id).limit(limit).all()
+
+def get_mutual_friends(db: Session, user_id: int, other_user_id: int, limit: int = 100):
+    """Get the friends two users have in common."""
+    theirs = FriendEdge.__table__.alias("theirs")
+    return db.query(User).join(
+        FriendEdge, FriendEdge.friend_id == User.id
+    ).join(
+        theirs, and_(theirs.c.user_id == other_user_id, theirs.c.friend_id == FriendEdge.friend_id)
+    ).filter(FriendEdge.user_id == user_id).order_by(User.adventurer_name, User.id).limit(limit).all()
+
+def encode_feed_cursor(item) -> str:
+    """Opaque cursor pointing just past an item in the friend feed."""
+    return base64.urlsafe_b64encode(f"{item.created_at.isoformat()}|{item.id}".encode()).decode()
+
+def decode_feed_cursor(cursor: str):
+    """Return the (created_at, id) position in a cursor; raises ValueError if malformed."""
+    try:
+        created_at, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), int(event_id)
+    except Exception:
+        raise ValueError("Invalid feed cursor")
+
+def get_friend_feed(db: Session, user_id: int, cursor: Optional[str] = None, limit: int = 50):
+    """Get friends' recent XP gains, newest first, with the quest each came from.
+
+    Each friend's newest `limit` events are read from ix_xp_events_user_created
+    and only those are merged, so the cost depends on the number of friends
+    and the page size, not on how much history the friends have. Pass the
+    cursor of the last item on a page (encode_feed_cursor) to get the next
+    one; it is a keyset position on (created_at, id), so events sharing a
+    timestamp are neither repeated nor skipped.
+    """
+    recent = select(XPEvent).where(XPEvent.user_id == FriendEdge.friend_id)
+    if cursor:
+        recent = recent.where(tuple_(XPEvent.created_at, XPEvent.id) < decode_feed_cursor(cursor))
+    recent = recent.order_by(XPEvent.created_at.desc(), XPEvent.id.desc()).limit(limit).lateral("recent")
+    return db.execute(
+        select(
+            recent.c.id, recent.c.user_id, User.adventurer_name, recent.c.amount, recent.c.source,
+            recent.c.source_id, Quest.title, recent.c.created_at
+        )
+        .select_from(FriendEdge)
+        .join(recent, literal(True))
+        .join(User, User.id == recent.c.user_id)
+        .outerjoin(Quest, and_(recent.c.source == "quest", Quest.id == recent.c.source_id))
+        .where(FriendEdge.user_id == user_id)
+        .order_by(recent.c.created_at.desc(), recent.c.id.desc())
+        .limit(limit)
     ).all()
 
 # Guild CRUD operations
@@ -152,6 +446,8 @@ def create_guild(db: Session, guild: GuildCreate, leader_id: int):
     db_member = GuildMember(user_id=leader_id, guild_id=db_guild.id, role="leader")
     db.add(db_member)
     db.commit()
+    after_commit(db, leaderboard.record_guild, db_guild.id, db_guild.name)
+    after_commit(db, leaderboard.record_guild_member, db_guild.id, leader_id)
     
     return db_guild
 
@@ -166,6 +462,12 @@ def get_user_guild(db: Session, user_id: int):
         return get_guild_by_id(db, member.guild_id)
     return None
 
+def is_guild_member(db: Session, guild_id: int, user_id: int) -> bool:
+    """Check whether a user belongs to a guild."""
+    return db.query(
+        db.query(GuildMember).filter(GuildMember.guild_id == guild_id, GuildMember.user_id == user_id).exists()
+    ).scalar()
+
 def add_guild_member(db: Session, guild_id: int, user_id: int, role: str = "member"):
     """Add a user to a guild."""
     existing = db.query(GuildMember).filter(
@@ -180,6 +482,7 @@ def add_guild_member(db: Session, guild_id: int, user_id: int, role: str = "memb
     db.add(db_member)
     db.commit()
     db.refresh(db_member)
+    after_commit(db, leaderboard.record_guild_member, guild_id, user_id)
     return db_member
 
 # Guild Quest CRUD operations
@@ -191,20 +494,36 @@ def create_guild_quest(db: Session, quest: GuildQuestCreate, guild_id: int):
     db.refresh(db_quest)
     return db_quest
 
-def update_guild_quest_progress(db: Session, quest_id: int, progress: int):
-    """Update guild quest progress."""
-    quest = db.query(GuildQuest).filter(GuildQuest.id == quest_id).first()
-    if not quest:
-        return None
-    
-    quest.current_value += progress
-    if quest.current_value >= quest.target_value and not quest.is_completed:
-        quest.is_completed = True
-        quest.completed_at = datetime.utcnow()
-    
+def get_guild_quest(db: Session, quest_id: int):
+    """Get a guild quest by ID."""
+    return db.query(GuildQuest).filter(GuildQuest.id == quest_id).first()
+
+def apply_guild_quest_progress(db: Session, progress: Dict[int, Tuple[int, Optional[datetime]]]):
+    """Add accumulated progress to several guild quests with one UPDATE.
+
+    progress maps quest id -> (amount, completed_at), where completed_at is
+    when the quest reached its target (None if it hasn't). Returns the number
+    of quests updated.
+    """
+    if not progress:
+        return 0
+    batch = values(
+        column("id", Integer), column("amount", Integer), column("completed_at", DateTime),
+        name="progress"
+    ).data([(quest_id, amount, completed_at) for quest_id, (amount, completed_at) in sorted(progress.items())])
+    completed_at = cast(batch.c.completed_at, DateTime)
+    result = db.execute(
+        update(GuildQuest)
+        .where(GuildQuest.id == batch.c.id)
+        .values(
+            current_value=func.coalesce(GuildQuest.current_value, 0) + batch.c.amount,
+            is_completed=func.coalesce(GuildQuest.is_completed, False) | completed_at.isnot(None),
+            completed_at=func.coalesce(GuildQuest.completed_at, completed_at)
+        )
+        .execution_options(synchronize_session=False)
+    )
     db.commit()
-    db.refresh(quest)
-    return quest
+    return result.rowcount
 
 def get_guild_quests(db: Session, guild_id: int):
     """Get all quests for a guild."""
@@ -1,8 +1,15 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, exc, inspect, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from app.models import Base
+from app.instrumentation import instrument_engine
+from app.metrics import DB_POOL_CHECKED_OUT, DB_POOL_CHECKOUT_SECONDS, DB_POOL_OVERFLOW, DB_POOL_TIMEOUTS
+import asyncio
 import os
+import time
+from typing import Callable, List, Tuple
 
 # Database URL from environment variables
 DATABASE_URL = os.getenv(
@@ -10,12 +17,91 @@ DATABASE_URL = os.getenv(
     "postgresql://questify:questify@db:5432/questify"
 )
 
+# Async URL uses the asyncpg driver against the same database
+ASYNC_DATABASE_URL = os.getenv(
+    "ASYNC_DATABASE_URL",
+    DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+)
+
+# Connection pool settings, per engine and per worker process: each worker
+# can open up to DB_POOL_SIZE + DB_MAX_OVERFLOW connections for sync requests,
+# as many again for async ones, and DB_BACKGROUND_POOL_SIZE for scheduled jobs
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_BACKGROUND_POOL_SIZE = int(os.getenv("DB_BACKGROUND_POOL_SIZE", "2"))
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections older than this many seconds are replaced (-1 to keep them)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+# Test connections before use so ones dropped by the server are replaced
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+class InstrumentedPoolMixin:
+    """Records pool metrics, labelled with the pool's logging name."""
+
+    def connect(self):
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            DB_POOL_TIMEOUTS.labels(pool=self.logging_name).inc()
+            raise
+        finally:
+            DB_POOL_CHECKOUT_SECONDS.labels(pool=self.logging_name).observe(time.perf_counter() - start)
+            DB_POOL_CHECKED_OUT.labels(pool=self.logging_name).set(self.checkedout())
+
+    def _do_return_conn(self, record):
+        super()._do_return_conn(record)
+        DB_POOL_CHECKED_OUT.labels(pool=self.logging_name).set(self.checkedout())
+
+    def _inc_overflow(self):
+        opened = super()._inc_overflow()
+        # _overflow counts up from -pool_size, so above 0 the pool is over its size
+        if opened and self._overflow > 0:
+            DB_POOL_OVERFLOW.labels(pool=self.logging_name).inc()
+        return opened
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+class InstrumentedAsyncQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
+
+def pool_options(name: str, pool_size: int = DB_POOL_SIZE, max_overflow: int = DB_MAX_OVERFLOW):
+    return {
+        "pool_size": pool_size,
+        "max_overflow": max_overflow,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+        "pool_logging_name": name,
+    }
+
 # Create SQLAlchemy engine
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, poolclass=InstrumentedQueuePool, **pool_options("sync"))
+
+# Create async SQLAlchemy engine
+async_engine = create_async_engine(ASYNC_DATABASE_URL, poolclass=InstrumentedAsyncQueuePool, **pool_options("async"))
+
+# Scheduled jobs get their own small pool, so they never hold up requests
+background_engine = create_engine(
+    DATABASE_URL, poolclass=InstrumentedQueuePool,
+    **pool_options("background", pool_size=DB_BACKGROUND_POOL_SIZE, max_overflow=0)
+)
+
+# Time every SQL statement, and count them per request
+for instrumented in (engine, async_engine.sync_engine, background_engine):
+    instrument_engine(instrumented)
 
 # Create SessionLocal class
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Sessions for scheduled jobs
+BackgroundSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=background_engine)
+
+# Create AsyncSessionLocal class
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 # Dependency to get database session
 def get_db():
     db = SessionLocal()
@@ -24,6 +110,116 @@ def get_db():
     finally:
         db.close()
 
+# Dependency to get async database session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+def after_commit(db: Session, fn: Callable, *args):
+    """Run fn(*args), a Redis side effect of a committed write.
+
+    It runs at once on a plain Session. Under run_sync it is deferred until
+    the sync function returns, then run in a worker thread.
+    """
+    deferred = db.info.get("after_commit")
+    if deferred is None:
+        fn(*args)
+    else:
+        deferred.append((fn, args))
+
+def _run_deferred(deferred: List[Tuple[Callable, tuple]]):
+    for fn, args in deferred:
+        fn(*args)
+
+async def run_sync(db: AsyncSession, fn: Callable, *args, **kwargs):
+    """AsyncSession.run_sync for CRUD functions that also write to Redis.
+
+    run_sync calls fn on the event loop thread, where a blocking Redis round
+    trip would stall every other request, so the Redis work fn hands to
+    after_commit runs in a thread once fn returns.
+    """
+    deferred: List[Tuple[Callable, tuple]] = []
+    db.sync_session.info["after_commit"] = deferred
+    try:
+        result = await db.run_sync(fn, *args, **kwargs)
+    finally:
+        db.sync_session.info.pop("after_commit", None)
+    if deferred:
+        await asyncio.to_thread(_run_deferred, deferred)
+    return result
+
+# Columns added to tables after they were first created. create_all never
+# alters an existing table, so these are added to it here
+ADDED_COLUMNS = {
+    "users": {
+        # Backfilled below, so left NULL for existing rows until then
+        "total_xp": "INTEGER",
+        "token_version": "INTEGER NOT NULL DEFAULT 0",
+    },
+}
+
+def _backfill_total_xp(conn):
+    """Give users who predate total_xp their lifetime XP, from their level and XP.
+
+    Uses the same level floors XP grants are leveled with, so a backfilled
+    user stays at their level.
+    """
+    # app.crud imports this module, so it can't be imported at the top
+    from app.crud import LEVEL_FLOORS
+    needs_backfill = "users.total_xp IS NULL OR (users.total_xp = 0 AND (users.level > 1 OR users.xp > 0))"
+    max_level = conn.execute(text(f"SELECT max(level) FROM users WHERE {needs_backfill}")).scalar()
+    if max_level is None:
+        return
+    floors = ", ".join(f"({level}, {floor})" for level, floor in enumerate(LEVEL_FLOORS[:max(max_level, 1)], 1))
+    conn.execute(text(f"""
+        UPDATE users SET total_xp = floors.xp_floor + COALESCE(users.xp, 0)
+        FROM (VALUES {floors}) AS floors(level, xp_floor)
+        WHERE floors.level = GREATEST(COALESCE(users.level, 1), 1) AND ({needs_backfill})
+    """))
+
+def _dedupe_friendships(conn):
+    """Keep one friendships row per pair of users so uq_friendships_pair can be built.
+
+    Before the index, opposite requests (A to B and B to A) could both be
+    stored. An accepted row wins over the others, then the oldest.
+    """
+    conn.execute(text("""
+        DELETE FROM friendships USING (
+            SELECT id, row_number() OVER (
+                PARTITION BY least(user_one_id, user_two_id), greatest(user_one_id, user_two_id)
+                ORDER BY (status = 'accepted') DESC, id
+            ) AS rank
+            FROM friendships
+        ) AS ranked
+        WHERE friendships.id = ranked.id AND ranked.rank > 1
+    """))
+
 # Create all tables
 def create_tables():
-    Base.metadata.create_all(bind=engine) 
\ No newline at end of file
+    had_friend_edges = inspect(engine).has_table("friend_edges")
+    Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {column["name"] for column in inspect(conn).get_columns(table)}
+            for name, ddl in columns.items():
+                if name not in existing:
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+        _backfill_total_xp(conn)
+        conn.execute(text("ALTER TABLE users ALTER COLUMN total_xp SET DEFAULT 0"))
+    if not had_friend_edges:
+        # Friendships accepted before friend_edges existed
+        with engine.begin() as conn:
+            conn.execute(text("""
+                INSERT INTO friend_edges (user_id, friend_id, created_at)
+                SELECT user_one_id, user_two_id, created_at FROM friendships WHERE status = 'accepted'
+                UNION ALL
+                SELECT user_two_id, user_one_id, created_at FROM friendships WHERE status = 'accepted'
+                ON CONFLICT DO NOTHING
+            """))
+    if "uq_friendships_pair" not in {index["name"] for index in inspect(engine).get_indexes("friendships")}:
+        with engine.begin() as conn:
+            _dedupe_friendships(conn)
+    # create_all skips tables that already exist, so add any of their new indexes
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine, checkfirst=True)
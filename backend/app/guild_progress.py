@@ -0,0 +1,189 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.cache import redis_client, async_redis_client, acquire_lock, release_lock
+from app.chat import room_channel
+from app.crud import get_guild_quest, apply_guild_quest_progress
+from app.database import BackgroundSessionLocal
+from app.metrics import GUILD_PROGRESS_FLUSHED
+from app.models import GuildQuest
+from datetime import datetime
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+# Guild quest progress is counted in Redis and folded into Postgres in
+# batches, so members reporting progress at once never contend on the quest
+# row. Each quest has a hash guild_quest:{id}:progress with
+#   total         progress so far (Postgres value plus everything counted since)
+#   pending       progress counted but not yet written to Postgres
+#   target        target_value, guild_id: copied from the quest
+#   completed_at  set once, by whichever update first reached the target
+DIRTY_KEY = "guild_quests:dirty"
+FLUSH_LOCK_KEY = "guild_quests:flush:lock"
+
+# Seconds between flushes to Postgres, and quests written per UPDATE
+GUILD_PROGRESS_FLUSH_INTERVAL = int(os.getenv("GUILD_PROGRESS_FLUSH_INTERVAL", "5"))
+GUILD_PROGRESS_FLUSH_BATCH = int(os.getenv("GUILD_PROGRESS_FLUSH_BATCH", "500"))
+
+# Counts progress and claims completion in one step. Returns nil if the quest
+# isn't loaded yet, else {total, target, guild_id, completed_at, newly completed}
+ADD_PROGRESS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+local total = redis.call('HINCRBY', KEYS[1], 'total', ARGV[1])
+redis.call('HINCRBY', KEYS[1], 'pending', ARGV[1])
+redis.call('SADD', KEYS[2], ARGV[2])
+local target = tonumber(redis.call('HGET', KEYS[1], 'target'))
+local completed = 0
+if total >= target then
+    completed = redis.call('HSETNX', KEYS[1], 'completed_at', ARGV[3])
+end
+return {total, target, redis.call('HGET', KEYS[1], 'guild_id'), redis.call('HGET', KEYS[1], 'completed_at') or '', completed}
+"""
+
+# Takes the pending progress of each quest, returning {pending, completed_at}
+TAKE_PENDING = """
+local taken = {}
+for i, key in ipairs(KEYS) do
+    local pending = tonumber(redis.call('HGET', key, 'pending') or '0')
+    if pending ~= 0 then
+        redis.call('HINCRBY', key, 'pending', -pending)
+    end
+    taken[i] = {pending, redis.call('HGET', key, 'completed_at') or ''}
+end
+return taken
+"""
+
+_add_progress = async_redis_client.register_script(ADD_PROGRESS)
+_take_pending = redis_client.register_script(TAKE_PENDING)
+
+class GuildProgressUnavailable(Exception):
+    """Raised when progress can't be counted because Redis is unreachable."""
+
+def progress_key(quest_id: int) -> str:
+    """Redis hash counting a guild quest's progress."""
+    return f"guild_quest:{quest_id}:progress"
+
+async def _load(quest: GuildQuest):
+    """Seed a quest's counter from Postgres, unless another request already has."""
+    fields = {
+        "total": quest.current_value or 0,
+        "pending": 0,
+        "target": quest.target_value or 0,
+        "guild_id": quest.guild_id,
+    }
+    if quest.is_completed:
+        fields["completed_at"] = (quest.completed_at or datetime.utcnow()).isoformat()
+    pipe = async_redis_client.pipeline()
+    for field, value in fields.items():
+        pipe.hsetnx(progress_key(quest.id), field, value)
+    await pipe.execute()
+
+async def add_progress(db: AsyncSession, quest_id: int, amount: int) -> Optional[Dict[str, Any]]:
+    """Add progress to a guild quest, returning its live state (None if it doesn't exist).
+
+    Only a quest's first update after a restart reads Postgres. The update
+    that reaches the target is the only one to see newly_completed, and
+    announces the completion to the guild.
+    """
+    keys = [progress_key(quest_id), DIRTY_KEY]
+    args = [amount, quest_id, datetime.utcnow().isoformat()]
+    try:
+        state = await _add_progress(keys=keys, args=args)
+        if state is None:
+            quest = await db.run_sync(get_guild_quest, quest_id)
+            if not quest:
+                return None
+            await _load(quest)
+            state = await _add_progress(keys=keys, args=args)
+    except Exception as e:
+        print(f"Error counting progress for guild quest {quest_id}: {e}")
+        raise GuildProgressUnavailable() from e
+
+    total, target, guild_id, completed_at, completed = state
+    progress = {
+        "quest_id": quest_id,
+        "guild_id": int(guild_id),
+        "current_value": int(total),
+        "target_value": int(target),
+        "is_completed": bool(completed_at),
+        "completed_at": datetime.fromisoformat(completed_at) if completed_at else None,
+        "newly_completed": bool(completed),
+    }
+    if progress["newly_completed"]:
+        await announce_completion(progress)
+    return progress
+
+async def announce_completion(progress: Dict[str, Any]):
+    """Tell the guild's chat room, on every process, that a quest was completed."""
+    event = {
+        "type": "guild_quest_completed",
+        "quest_id": progress["quest_id"],
+        "current_value": progress["current_value"],
+        "target_value": progress["target_value"],
+        "timestamp": progress["completed_at"].isoformat(),
+    }
+    try:
+        await async_redis_client.publish(room_channel(progress["guild_id"]), json.dumps(event))
+    except Exception as e:
+        print(f"Error announcing completion of guild quest {progress['quest_id']}: {e}")
+
+async def with_live_progress(quests: List[GuildQuest]) -> List[Dict[str, Any]]:
+    """Guild quests with the progress counted in Redis but not yet flushed."""
+    rows = [{column.name: getattr(quest, column.name) for column in GuildQuest.__table__.columns} for quest in quests]
+    if not rows:
+        return rows
+    try:
+        pipe = async_redis_client.pipeline(transaction=False)
+        for row in rows:
+            pipe.hmget(progress_key(row["id"]), "total", "completed_at")
+        live = await pipe.execute()
+    except Exception as e:
+        print(f"Error reading guild quest progress: {e}")
+        return rows
+    for row, (total, completed_at) in zip(rows, live):
+        if total is not None:
+            row["current_value"] = max(int(total), row["current_value"] or 0)
+        if completed_at and not row["is_completed"]:
+            row["is_completed"] = True
+            row["completed_at"] = datetime.fromisoformat(completed_at)
+    return rows
+
+def flush_progress() -> int:
+    """Write the progress counted in Redis to Postgres. Returns the quests updated.
+
+    Progress taken from Redis is put back if the write fails, so it is
+    retried on the next flush rather than lost.
+    """
+    # One flusher at a time, so concurrent batches never lock rows against each other
+    lock = acquire_lock(FLUSH_LOCK_KEY, max(GUILD_PROGRESS_FLUSH_INTERVAL * 6, 30))
+    if lock is None:
+        return 0
+    flushed = 0
+    try:
+        while True:
+            quest_ids = redis_client.spop(DIRTY_KEY, GUILD_PROGRESS_FLUSH_BATCH)
+            if not quest_ids:
+                return flushed
+            taken = _take_pending(keys=[progress_key(quest_id) for quest_id in quest_ids])
+            progress = {
+                int(quest_id): (int(pending), datetime.fromisoformat(completed_at) if completed_at else None)
+                for quest_id, (pending, completed_at) in zip(quest_ids, taken)
+                if int(pending) or completed_at
+            }
+            db = BackgroundSessionLocal()
+            try:
+                flushed += apply_guild_quest_progress(db, progress)
+            except Exception:
+                db.rollback()
+                pipe = redis_client.pipeline()
+                for quest_id, (amount, _) in progress.items():
+                    pipe.hincrby(progress_key(quest_id), "pending", amount)
+                    pipe.sadd(DIRTY_KEY, quest_id)
+                pipe.execute()
+                raise
+            finally:
+                db.close()
+            GUILD_PROGRESS_FLUSHED.inc(len(progress))
+    finally:
+        release_lock(FLUSH_LOCK_KEY, lock)
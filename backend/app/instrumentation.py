@@ -0,0 +1,104 @@
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.metrics import (
+    HTTP_REQUESTS, HTTP_REQUEST_SECONDS, HTTP_REQUESTS_IN_PROGRESS,
+    DB_QUERY_SECONDS, DB_REQUEST_QUERIES, DB_REQUEST_QUERY_SECONDS
+)
+import time
+from typing import Optional
+
+class RequestStats:
+    """Database work done while serving one request, and who it was for."""
+
+    __slots__ = ("queries", "query_seconds", "wrote", "user_id")
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.wrote = False
+        self.user_id: Optional[int] = None
+
+# Set for the duration of each HTTP request. Sync routes and dependencies run
+# in worker threads with a copy of the context, so they share this object
+# rather than setting the variable themselves.
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_start"].pop()
+    DB_QUERY_SECONDS.observe(elapsed)
+    stats = request_stats.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.query_seconds += elapsed
+
+def _commit(conn):
+    stats = request_stats.get()
+    if stats is not None:
+        stats.wrote = True
+
+def _handle_error(exception_context):
+    # after_cursor_execute doesn't run for failed statements
+    connection = exception_context.connection
+    if connection is not None and connection.info.get("query_start"):
+        connection.info["query_start"].pop()
+
+def instrument_engine(engine: Engine):
+    """Time every statement run on an engine, and note commits (use .sync_engine for async engines)."""
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+    event.listen(engine, "commit", _commit)
+
+def note_user(user_id: int):
+    """Record which user the current request is acting for."""
+    stats = request_stats.get()
+    if stats is not None:
+        stats.user_id = user_id
+
+class MetricsMiddleware:
+    """Records latency, status and database work for every HTTP request.
+
+    Requests are labelled with their route template (/quests/{quest_id}/complete,
+    not the concrete path), so the number of series stays bounded. The
+    duration runs until the response body is fully sent, which for streaming
+    routes includes the whole stream.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        status_code = 500
+        stats = RequestStats()
+        token = request_stats.set(stats)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.labels(method=method).inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_stats.reset(token)
+            HTTP_REQUESTS_IN_PROGRESS.labels(method=method).dec()
+            # The router adds the matched route to the scope
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(method=method, route=path).observe(elapsed)
+            HTTP_REQUESTS.labels(method=method, route=path, status=str(status_code)).inc()
+            DB_REQUEST_QUERIES.labels(method=method, route=path).observe(stats.queries)
+            DB_REQUEST_QUERY_SECONDS.labels(method=method, route=path).observe(stats.query_seconds)
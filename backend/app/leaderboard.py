@@ -0,0 +1,488 @@
+from sqlalchemy import func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from app.cache import redis_client, async_redis_client
+from app.database import BackgroundSessionLocal
+from app.metrics import LEADERBOARD_CACHE_LOOKUPS, FRIEND_LEADERBOARD_LOOKUPS
+from app.models import FriendEdge, Guild, GuildMember, User, XPEvent
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+# All-time XP leaderboard: sorted set of user id -> total XP
+LEADERBOARD_KEY = "leaderboard:xp"
+# Display fields for leaderboard entries: hash of user id -> JSON profile
+PROFILES_KEY = "leaderboard:profiles"
+# Guild leaderboard: sorted set of guild id -> summed total XP of its members
+GUILD_LEADERBOARD_KEY = "leaderboard:guilds"
+# Guild names for guild leaderboard entries: hash of guild id -> name
+GUILD_NAMES_KEY = "leaderboard:guild_names"
+
+REBUILD_BATCH_SIZE = 1000
+
+# XP gained per user in each time bucket: (key format, bucket length, key TTL in seconds)
+BUCKETS = {
+    "hour": ("%Y%m%d%H", timedelta(hours=1), 26 * 3600),
+    "day": ("%Y%m%d", timedelta(days=1), 32 * 86400),
+}
+# Rolling windows as (bucket granularity, number of buckets merged)
+WINDOWS = {
+    "daily": ("hour", 24),
+    "weekly": ("day", 7),
+    "monthly": ("day", 30),
+}
+TIMEFRAMES = ("alltime",) + tuple(WINDOWS)
+
+# How long a merged window is served before its buckets are merged again
+WINDOW_CACHE_TTL = int(os.getenv("LEADERBOARD_WINDOW_CACHE_TTL", "30"))
+
+# Friends leaderboards. Each user with friends has a set friends:{id} holding
+# their friends' ids and their own. A user's all-time friends view,
+# leaderboard:friends:{id}, is intersected from it and the global scores on
+# first read and then kept current by XP changes and accepted friendships
+# for FRIENDS_VIEW_TTL seconds. Users with more than FRIENDS_VIEW_MAX friends
+# only get views for WINDOW_CACHE_TTL seconds, and their XP changes aren't
+# fanned out (their friends see them move once their views are rebuilt), so
+# a huge friend list costs neither memory nor write time.
+FRIENDS_VIEW_TTL = int(os.getenv("LEADERBOARD_FRIENDS_VIEW_TTL", "900"))
+FRIENDS_VIEW_MAX = int(os.getenv("LEADERBOARD_FRIENDS_VIEW_MAX", "1000"))
+
+# Adds two new friends to each other's friend sets and views, where those exist
+ADD_FRIENDS = """
+for i = 1, 2 do
+    local other = ARGV[3 - i]
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('SADD', KEYS[i], other)
+    end
+    local score = redis.call('ZSCORE', KEYS[5], other)
+    if score and redis.call('EXISTS', KEYS[i + 2]) == 1 then
+        redis.call('ZADD', KEYS[i + 2], score, other)
+    end
+end
+"""
+
+# Raises a user's total (ZADD GT) and adds the XP they were granted to each
+# of their guilds. The grant comes from the caller rather than the change in
+# the global score, so a missing or evicted leaderboard:xp doesn't add a
+# user's whole lifetime total to their guilds again
+RECORD_SCORE = """
+redis.call('ZADD', KEYS[1], 'GT', ARGV[2], ARGV[1])
+local gained = tonumber(ARGV[3])
+if gained > 0 then
+    for _, guild_id in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+        redis.call('ZINCRBY', KEYS[3], gained, guild_id)
+    end
+end
+return gained
+"""
+
+# Adds a new member's total XP to a guild, once per membership
+ADD_GUILD_MEMBER = """
+if redis.call('SADD', KEYS[1], ARGV[2]) == 1 then
+    redis.call('ZINCRBY', KEYS[3], tonumber(redis.call('ZSCORE', KEYS[2], ARGV[1]) or '0'), ARGV[2])
+end
+"""
+
+_record_score = redis_client.register_script(RECORD_SCORE)
+_add_friends = redis_client.register_script(ADD_FRIENDS)
+_add_guild_member = redis_client.register_script(ADD_GUILD_MEMBER)
+
+def _profile(user: User) -> str:
+    return json.dumps({
+        "adventurer_name": user.adventurer_name,
+        "level": user.level,
+        "xp": user.xp,
+        "total_xp": user.total_xp or 0
+    })
+
+def record_score(user: User, gained: int = 0):
+    """Record a user's current total XP on the leaderboard after a grant of `gained` XP.
+
+    Scores only move up, so ZADD GT keeps the highest total even when updates
+    from concurrent requests arrive out of order. The user's guilds go up by
+    `gained`. Each update is O(log N),
+    plus O(log G) for each of the user's guilds and O(log N) for each of
+    their friends viewing a friends leaderboard.
+    """
+    try:
+        # Friends whose views this total has to move in; every key a command
+        # touches is named in it, so none are built inside a script
+        size = redis_client.scard(friends_key(user.id))
+        friend_ids = redis_client.smembers(friends_key(user.id)) if 0 < size <= FRIENDS_VIEW_MAX else ()
+        pipe = redis_client.pipeline(transaction=False)
+        _record_score(
+            keys=[LEADERBOARD_KEY, user_guilds_key(user.id), GUILD_LEADERBOARD_KEY],
+            args=[user.id, user.total_xp or 0, gained], client=pipe
+        )
+        pipe.hset(PROFILES_KEY, str(user.id), _profile(user))
+        for friend_id in friend_ids:
+            pipe.zadd(friends_view_key(int(friend_id)), {str(user.id): user.total_xp or 0}, xx=True, gt=True)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error updating leaderboard for user {user.id}: {e}")
+
+def _bucket_start(at: datetime, granularity: str) -> datetime:
+    if granularity == "hour":
+        return at.replace(minute=0, second=0, microsecond=0)
+    return at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def bucket_key(granularity: str, at: datetime) -> str:
+    """Return the Redis key of the bucket containing a (UTC) moment."""
+    key_format = BUCKETS[granularity][0]
+    return f"leaderboard:xp:{granularity}:{at.strftime(key_format)}"
+
+def record_xp_event(user_id: int, amount: int, at: datetime):
+    """Add an XP grant to the hourly and daily buckets it falls in."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for granularity, (_, _, ttl) in BUCKETS.items():
+            key = bucket_key(granularity, at)
+            pipe.zincrby(key, amount, str(user_id))
+            pipe.expire(key, ttl)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error recording XP event for user {user_id}: {e}")
+
+def window_key(timeframe: str) -> str:
+    """Return the sorted set holding XP per user for a timeframe.
+
+    Windows are merged from a fixed number of buckets (24 hourly, or 7 or 30
+    daily) with ZUNIONSTORE, so the cost doesn't grow with the amount of
+    history kept. The merge is cached for WINDOW_CACHE_TTL seconds.
+    """
+    if timeframe == "alltime":
+        return LEADERBOARD_KEY
+    key = f"leaderboard:window:{timeframe}"
+    if redis_client.exists(key):
+        LEADERBOARD_CACHE_LOOKUPS.labels(timeframe=timeframe, result="hit").inc()
+        return key
+    LEADERBOARD_CACHE_LOOKUPS.labels(timeframe=timeframe, result="miss").inc()
+
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.zunionstore(key, _window_buckets(timeframe))
+    pipe.expire(key, WINDOW_CACHE_TTL)
+    pipe.execute()
+    return key
+
+async def window_key_async(timeframe: str) -> str:
+    """window_key for the event loop."""
+    if timeframe == "alltime":
+        return LEADERBOARD_KEY
+    key = f"leaderboard:window:{timeframe}"
+    if await async_redis_client.exists(key):
+        LEADERBOARD_CACHE_LOOKUPS.labels(timeframe=timeframe, result="hit").inc()
+        return key
+    LEADERBOARD_CACHE_LOOKUPS.labels(timeframe=timeframe, result="miss").inc()
+
+    pipe = async_redis_client.pipeline(transaction=True)
+    pipe.zunionstore(key, _window_buckets(timeframe))
+    pipe.expire(key, WINDOW_CACHE_TTL)
+    await pipe.execute()
+    return key
+
+def _window_buckets(timeframe: str) -> List[str]:
+    granularity, count = WINDOWS[timeframe]
+    step = BUCKETS[granularity][1]
+    now = datetime.utcnow()
+    return [bucket_key(granularity, now - step * i) for i in range(count)]
+
+def _entries(members: List[tuple], first_rank: int) -> List[Dict[str, Any]]:
+    if not members:
+        return []
+    profiles = redis_client.hmget(PROFILES_KEY, [user_id for user_id, _ in members])
+    return _profile_entries(members, profiles, first_rank)
+
+async def _entries_async(members: List[tuple], first_rank: int) -> List[Dict[str, Any]]:
+    if not members:
+        return []
+    profiles = await async_redis_client.hmget(PROFILES_KEY, [user_id for user_id, _ in members])
+    return _profile_entries(members, profiles, first_rank)
+
+def _profile_entries(members: List[tuple], profiles: List[Optional[str]], first_rank: int) -> List[Dict[str, Any]]:
+    entries = []
+    for offset, ((user_id, score), profile) in enumerate(zip(members, profiles)):
+        profile = json.loads(profile) if profile else {"adventurer_name": "Unknown", "level": 1, "xp": 0, "total_xp": 0}
+        entries.append({
+            **profile,
+            "user_id": int(user_id),
+            "rank": first_rank + offset,
+            "period_xp": int(score)
+        })
+    return entries
+
+def get_top(limit: int = 100, timeframe: str = "alltime") -> List[Dict[str, Any]]:
+    """Return the top-N leaderboard entries for a timeframe."""
+    members = redis_client.zrevrange(window_key(timeframe), 0, limit - 1, withscores=True)
+    return _entries(members, 1)
+
+def get_rank(user_id: int, timeframe: str = "alltime") -> Optional[int]:
+    """Return a user's 1-based rank, or None if they aren't ranked."""
+    rank = redis_client.zrevrank(window_key(timeframe), str(user_id))
+    return None if rank is None else rank + 1
+
+def get_around(user_id: int, radius: int = 5, timeframe: str = "alltime") -> List[Dict[str, Any]]:
+    """Return the entries ranked within `radius` places of a user."""
+    key = window_key(timeframe)
+    rank = redis_client.zrevrank(key, str(user_id))
+    if rank is None:
+        return []
+    start = max(0, rank - radius)
+    members = redis_client.zrevrange(key, start, rank + radius, withscores=True)
+    return _entries(members, start + 1)
+
+def friends_key(user_id: int) -> str:
+    """Redis set of a user's friends' ids, and their own."""
+    return f"friends:{user_id}"
+
+def friends_view_key(user_id: int, timeframe: str = "alltime") -> str:
+    """Redis sorted set ranking a user and their friends for a timeframe."""
+    if timeframe == "alltime":
+        return f"leaderboard:friends:{user_id}"
+    return f"leaderboard:friends:{user_id}:{timeframe}"
+
+def record_friendship(user_id: int, friend_id: int):
+    """Add two users to each other's friend sets and friends leaderboards once they're friends."""
+    keys = [
+        friends_key(user_id), friends_key(friend_id),
+        friends_view_key(user_id), friends_view_key(friend_id),
+        LEADERBOARD_KEY
+    ]
+    # Runs after the accepting request's commit, off the request, so it reads
+    # with a background session; it only connects if a set has to be loaded
+    db = BackgroundSessionLocal()
+    try:
+        # Either set may not be in Redis yet; loading it picks up the new edge
+        _load_friends(db, user_id)
+        _load_friends(db, friend_id)
+        _add_friends(keys=keys, args=[user_id, friend_id])
+    except Exception as e:
+        print(f"Error updating friends leaderboards for users {user_id} and {friend_id}: {e}")
+    finally:
+        db.close()
+
+def _load_friends(db: Session, user_id: int) -> int:
+    """Load a user's friend set from friend_edges unless it's in Redis. Returns its size."""
+    key = friends_key(user_id)
+    size = redis_client.scard(key)
+    if size:
+        return size
+    friend_ids = _friend_ids(db, user_id)
+    redis_client.sadd(key, user_id, *friend_ids)
+    return len(friend_ids) + 1
+
+def _friend_ids(db: Session, user_id: int) -> List[int]:
+    return [friend_id for friend_id, in db.query(FriendEdge.friend_id).filter(FriendEdge.user_id == user_id)]
+
+async def _load_friends_async(db: AsyncSession, user_id: int) -> int:
+    """_load_friends for the event loop."""
+    key = friends_key(user_id)
+    size = await async_redis_client.scard(key)
+    if size:
+        return size
+    friend_ids = await db.run_sync(_friend_ids, user_id)
+    await async_redis_client.sadd(key, user_id, *friend_ids)
+    return len(friend_ids) + 1
+
+async def friends_view(db: AsyncSession, user_id: int, timeframe: str = "alltime") -> str:
+    """Return the sorted set ranking a user among their friends for a timeframe.
+
+    Built with one ZINTERSTORE of the friend set against the timeframe's
+    scores, so friends with no XP in a window aren't ranked in it. Window
+    views are rebuilt every WINDOW_CACHE_TTL seconds; all-time views are
+    kept current by record_score and record_friendship until they expire.
+    """
+    key = friends_view_key(user_id, timeframe)
+    if await async_redis_client.exists(key):
+        FRIEND_LEADERBOARD_LOOKUPS.labels(timeframe=timeframe, result="hit").inc()
+        return key
+    FRIEND_LEADERBOARD_LOOKUPS.labels(timeframe=timeframe, result="miss").inc()
+
+    size = await _load_friends_async(db, user_id)
+    ttl = FRIENDS_VIEW_TTL if timeframe == "alltime" and size <= FRIENDS_VIEW_MAX else WINDOW_CACHE_TTL
+    scores = await window_key_async(timeframe)
+    pipe = async_redis_client.pipeline(transaction=True)
+    pipe.zinterstore(key, {friends_key(user_id): 0, scores: 1})
+    pipe.expire(key, ttl)
+    await pipe.execute()
+    return key
+
+async def get_friends_position(db: AsyncSession, user_id: int, limit: int = 100, timeframe: str = "alltime") -> tuple:
+    """Return a user's 1-based rank among their friends (None if unranked) and the top-N of them."""
+    key = await friends_view(db, user_id, timeframe)
+    pipe = async_redis_client.pipeline(transaction=False)
+    pipe.zrevrank(key, str(user_id))
+    pipe.zrevrange(key, 0, limit - 1, withscores=True)
+    rank, members = await pipe.execute()
+    return None if rank is None else rank + 1, await _entries_async(members, 1)
+
+def user_guilds_key(user_id: int) -> str:
+    """Redis set of the ids of the guilds a user belongs to."""
+    return f"guilds:member:{user_id}"
+
+def record_guild(guild_id: int, name: str):
+    """Put a guild on the guild leaderboard, with no XP until members are added."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.hset(GUILD_NAMES_KEY, str(guild_id), name)
+        pipe.zadd(GUILD_LEADERBOARD_KEY, {str(guild_id): 0}, nx=True)
+        pipe.execute()
+    except Exception as e:
+        print(f"Error adding guild {guild_id} to the guild leaderboard: {e}")
+
+def record_guild_member(guild_id: int, user_id: int):
+    """Add a new member's total XP to their guild's, and count their future XP towards it."""
+    try:
+        _add_guild_member(keys=[user_guilds_key(user_id), LEADERBOARD_KEY, GUILD_LEADERBOARD_KEY], args=[user_id, guild_id])
+    except Exception as e:
+        print(f"Error adding user {user_id} to guild {guild_id} on the guild leaderboard: {e}")
+
+def _guild_entries(members: List[tuple], first_rank: int) -> List[Dict[str, Any]]:
+    if not members:
+        return []
+    names = redis_client.hmget(GUILD_NAMES_KEY, [guild_id for guild_id, _ in members])
+    return [
+        {"guild_id": int(guild_id), "name": name or "Unknown", "total_xp": int(score), "rank": first_rank + offset}
+        for offset, ((guild_id, score), name) in enumerate(zip(members, names))
+    ]
+
+def get_guild_top(limit: int = 100) -> List[Dict[str, Any]]:
+    """Return the top-N guilds by their members' total XP."""
+    members = redis_client.zrevrange(GUILD_LEADERBOARD_KEY, 0, limit - 1, withscores=True)
+    return _guild_entries(members, 1)
+
+def get_guild_entry(guild_id: int) -> Optional[Dict[str, Any]]:
+    """Return a guild's guild leaderboard entry, or None if it isn't ranked."""
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zrevrank(GUILD_LEADERBOARD_KEY, str(guild_id))
+    pipe.zscore(GUILD_LEADERBOARD_KEY, str(guild_id))
+    rank, score = pipe.execute()
+    if rank is None:
+        return None
+    return _guild_entries([(str(guild_id), score)], rank + 1)[0]
+
+def rebuild(db: Session) -> int:
+    """Reconcile the leaderboard with Postgres.
+
+    Restores a lost or stale sorted set without a DB sort. Writes use
+    ZADD GT, so a reconcile racing with live XP updates never moves a score
+    backwards.
+    """
+    count = 0
+    query = db.query(
+        User.id, User.adventurer_name, User.level, User.xp, User.total_xp
+    ).order_by(User.id).yield_per(REBUILD_BATCH_SIZE)
+    pipe = redis_client.pipeline(transaction=False)
+    for user in query:
+        pipe.zadd(LEADERBOARD_KEY, {str(user.id): user.total_xp or 0}, gt=True)
+        pipe.hset(PROFILES_KEY, str(user.id), _profile(user))
+        count += 1
+        if count % REBUILD_BATCH_SIZE == 0:
+            pipe.execute()
+    pipe.execute()
+    return count
+
+def rebuild_friends(db: Session) -> int:
+    """Reconcile the friend sets with friend_edges. Returns the number of sets written.
+
+    A user's XP changes are fanned out to their friends' views from their
+    own set, so sets lost from Redis are restored here rather than waiting
+    for their owner to read a friends leaderboard.
+    """
+    count = 0
+    pipe = redis_client.pipeline(transaction=False)
+
+    def write(user_id: int, friend_ids: List[int]):
+        nonlocal count
+        pipe.sadd(friends_key(user_id), user_id, *friend_ids)
+        count += 1
+        if count % REBUILD_BATCH_SIZE == 0:
+            pipe.execute()
+
+    query = db.query(FriendEdge.user_id, FriendEdge.friend_id).order_by(
+        FriendEdge.user_id
+    ).yield_per(REBUILD_BATCH_SIZE)
+    user_id, friend_ids = None, []
+    for edge_user_id, friend_id in query:
+        if edge_user_id != user_id and friend_ids:
+            write(user_id, friend_ids)
+            friend_ids = []
+        user_id = edge_user_id
+        friend_ids.append(friend_id)
+    if friend_ids:
+        write(user_id, friend_ids)
+    pipe.execute()
+    return count
+
+def rebuild_guilds(db: Session) -> int:
+    """Reconcile the guild leaderboard and members' guild sets with Postgres.
+
+    Guild totals are summed in one GROUP BY here, off the request path,
+    into a fresh sorted set that then replaces the live one with RENAME, so
+    totals that went down and guilds that no longer exist are corrected too.
+    Live updates made while it runs are lost until the next reconcile.
+    Returns the number of guilds written.
+    """
+    staging_key = f"{GUILD_LEADERBOARD_KEY}:rebuild"
+    pipe = redis_client.pipeline(transaction=False)
+    memberships = db.query(GuildMember.user_id, GuildMember.guild_id).yield_per(REBUILD_BATCH_SIZE)
+    for i, (user_id, guild_id) in enumerate(memberships, 1):
+        pipe.sadd(user_guilds_key(user_id), guild_id)
+        if i % REBUILD_BATCH_SIZE == 0:
+            pipe.execute()
+    pipe.execute()
+
+    count = 0
+    pipe.delete(staging_key)
+    totals = db.query(
+        Guild.id, Guild.name, func.coalesce(func.sum(User.total_xp), 0)
+    ).outerjoin(GuildMember, GuildMember.guild_id == Guild.id).outerjoin(
+        User, User.id == GuildMember.user_id
+    ).group_by(Guild.id).yield_per(REBUILD_BATCH_SIZE)
+    for guild_id, name, total_xp in totals:
+        pipe.hset(GUILD_NAMES_KEY, str(guild_id), name)
+        pipe.zadd(staging_key, {str(guild_id): int(total_xp)})
+        count += 1
+        if count % REBUILD_BATCH_SIZE == 0:
+            pipe.execute()
+    if count:
+        pipe.rename(staging_key, GUILD_LEADERBOARD_KEY)
+    else:
+        pipe.delete(GUILD_LEADERBOARD_KEY)
+    pipe.execute()
+    return count
+
+def rebuild_windows(db: Session) -> int:
+    """Rebuild the closed time buckets from the XP ledger.
+
+    Only buckets that have already ended are rebuilt; the current bucket
+    is still receiving live increments. Returns the number of buckets written.
+    """
+    now = datetime.utcnow()
+    written = 0
+    for granularity, (_, step, ttl) in BUCKETS.items():
+        span = max(count for bucket_granularity, count in WINDOWS.values() if bucket_granularity == granularity)
+        current = _bucket_start(now, granularity)
+        since = current - step * span
+
+        bucket = func.date_trunc(granularity, XPEvent.created_at).label("bucket")
+        rows = db.query(bucket, XPEvent.user_id, func.sum(XPEvent.amount)).filter(
+            XPEvent.created_at >= since,
+            XPEvent.created_at < current
+        ).group_by(bucket, XPEvent.user_id).all()
+
+        scores = defaultdict(dict)
+        for bucket_start, user_id, amount in rows:
+            scores[bucket_key(granularity, bucket_start)][str(user_id)] = int(amount)
+
+        pipe = redis_client.pipeline(transaction=True)
+        for i in range(1, span + 1):
+            key = bucket_key(granularity, current - step * i)
+            pipe.delete(key)
+            if key in scores:
+                pipe.zadd(key, scores[key])
+                pipe.expire(key, ttl)
+                written += 1
+        pipe.execute()
+    return written
@@ -0,0 +1,288 @@
+import chromadb
+from app.cache import acquire_lock, release_lock
+from app.metrics import MEMORY_QUEUE_DEPTH, MEMORY_FLUSH_BATCH_SIZE, MEMORY_WRITES
+import asyncio
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict
+from typing import Any, Callable, Dict, List, Optional
+from urllib.parse import urlparse
+
+# Vector store location: a Chroma server if CHROMADB_URL is set, else a local directory
+CHROMADB_URL = os.getenv("CHROMADB_URL")
+CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./chroma_data")
+
+# Partitioning: "user" gives each user a collection, "shard" hashes users into MEMORY_SHARDS
+MEMORY_PARTITIONING = os.getenv("MEMORY_PARTITIONING", "user")
+MEMORY_SHARDS = int(os.getenv("MEMORY_SHARDS", "16"))
+# Collection handles kept per process, least recently used dropped first
+MEMORY_COLLECTION_CACHE_SIZE = int(os.getenv("MEMORY_COLLECTION_CACHE_SIZE", "1024"))
+
+# Retention: memories past either limit are compacted into a digest
+MEMORY_MAX_PER_USER = int(os.getenv("MEMORY_MAX_PER_USER", "200"))
+MEMORY_RETENTION_DAYS = int(os.getenv("MEMORY_RETENTION_DAYS", "30"))
+MEMORY_DIGEST_CHARS = int(os.getenv("MEMORY_DIGEST_CHARS", "2000"))
+# Every worker schedules compaction; only the one holding this lock runs it
+COMPACT_LOCK_KEY = "memories:compact:lock"
+COMPACT_LOCK_TTL = 6 * 3600
+
+# Write-behind settings
+MEMORY_BATCH_SIZE = int(os.getenv("MEMORY_BATCH_SIZE", "64"))
+MEMORY_FLUSH_INTERVAL = float(os.getenv("MEMORY_FLUSH_INTERVAL", "2"))
+MEMORY_QUEUE_SIZE = int(os.getenv("MEMORY_QUEUE_SIZE", "10000"))
+MEMORY_SHUTDOWN_TIMEOUT = float(os.getenv("MEMORY_SHUTDOWN_TIMEOUT", "30"))
+
+def create_chroma_client():
+    """Create a persistent Chroma client shared by memories and the response cache."""
+    if CHROMADB_URL:
+        url = urlparse(CHROMADB_URL)
+        return chromadb.HttpClient(host=url.hostname, port=url.port or 8000, ssl=url.scheme == "https")
+    return chromadb.PersistentClient(path=CHROMA_PERSIST_DIR)
+
+_chroma_client = None
+_chroma_client_lock = threading.Lock()
+
+def get_chroma_client():
+    """Return the shared Chroma client, creating it on first use.
+
+    An HttpClient fails to construct while the Chroma server is still
+    starting, so it isn't created at import time; a failed attempt raises
+    to the caller and is retried on the next call.
+    """
+    global _chroma_client
+    if _chroma_client is None:
+        with _chroma_client_lock:
+            if _chroma_client is None:
+                _chroma_client = create_chroma_client()
+    return _chroma_client
+
+class MemoryStore:
+    """Oracle memories partitioned into per-user or per-shard Chroma collections.
+
+    With per-user partitioning a query only searches that user's memories,
+    so retrieval time depends on the user's own history rather than on the
+    total number of memories stored.
+    """
+
+    prefix = "user_memories_"
+
+    def __init__(self, get_client: Callable[[], Any], partitioning: str = MEMORY_PARTITIONING, shards: int = MEMORY_SHARDS,
+                 max_collections: int = MEMORY_COLLECTION_CACHE_SIZE):
+        if partitioning not in ("user", "shard"):
+            raise ValueError(f"Unknown MEMORY_PARTITIONING: {partitioning}")
+        self.get_client = get_client
+        self.partitioning = partitioning
+        self.shards = shards
+        self.max_collections = max_collections
+        self._collections: OrderedDict = OrderedDict()
+        self._collections_lock = threading.Lock()
+
+    @property
+    def client(self):
+        return self.get_client()
+
+    def collection_name(self, user_id: int) -> str:
+        if self.partitioning == "user":
+            return f"{self.prefix}u{user_id}"
+        return f"{self.prefix}s{user_id % self.shards}"
+
+    def _collection(self, name: str, create: bool):
+        with self._collections_lock:
+            collection = self._collections.get(name)
+            if collection is not None:
+                self._collections.move_to_end(name)
+                return collection
+        try:
+            collection = self.client.get_collection(name)
+        except Exception:
+            if not create:
+                return None
+            collection = self.client.get_or_create_collection(name)
+        with self._collections_lock:
+            self._collections[name] = collection
+            self._collections.move_to_end(name)
+            while len(self._collections) > self.max_collections:
+                self._collections.popitem(last=False)
+        return collection
+
+    def _user_filter(self, user_id: int) -> Optional[Dict[str, str]]:
+        # Per-user collections need no filter; shards are shared
+        return {"user_id": str(user_id)} if self.partitioning == "shard" else None
+
+    def query(self, user_id: int, query: str, limit: int = 5) -> List[str]:
+        """Return the user's memories most relevant to the query."""
+        collection = self._collection(self.collection_name(user_id), create=False)
+        if collection is None:
+            return []
+        results = collection.query(
+            query_texts=[query],
+            n_results=limit,
+            where=self._user_filter(user_id)
+        )
+        return results['documents'][0] if results['documents'] else []
+
+    def add(self, memories: List[Dict]):
+        """Add memories, one collection.add per partition."""
+        partitions = defaultdict(list)
+        for memory in memories:
+            partitions[self.collection_name(memory["user_id"])].append(memory)
+        for name, batch in partitions.items():
+            self._collection(name, create=True).add(
+                documents=[memory["document"] for memory in batch],
+                metadatas=[memory["metadata"] for memory in batch],
+                ids=[memory["id"] for memory in batch]
+            )
+
+    def compact(self) -> int:
+        """Fold each user's expired or excess memories into a single digest.
+
+        Memories older than MEMORY_RETENTION_DAYS, and the oldest memories
+        beyond MEMORY_MAX_PER_USER, are replaced by one digest memory built
+        from their text. Returns the number of memories removed, or None if
+        another worker is already compacting.
+        """
+        # Concurrent runs would each write a digest of the same memories
+        lock = acquire_lock(COMPACT_LOCK_KEY, COMPACT_LOCK_TTL)
+        if lock is None:
+            return None
+        try:
+            return self._compact()
+        finally:
+            release_lock(COMPACT_LOCK_KEY, lock)
+
+    def _compact(self) -> int:
+        cutoff = time.time() - MEMORY_RETENTION_DAYS * 86400
+        removed = 0
+        for collection in self.client.list_collections():
+            if not collection.name.startswith(self.prefix):
+                continue
+            entries = collection.get(include=["documents", "metadatas"])
+            by_user = defaultdict(list)
+            for entry_id, document, metadata in zip(entries["ids"], entries["documents"], entries["metadatas"]):
+                by_user[metadata["user_id"]].append((float(metadata["timestamp"]), entry_id, document))
+
+            for user_id, user_memories in by_user.items():
+                user_memories.sort()
+                overflow = len(user_memories) - MEMORY_MAX_PER_USER
+                stale = [m for i, m in enumerate(user_memories) if m[0] < cutoff or i < overflow]
+                if len(stale) < 2:
+                    continue
+                # Newest first, so truncation drops the oldest text
+                digest = "Summary of earlier interactions: " + " / ".join(document for _, _, document in reversed(stale))
+                collection.add(
+                    documents=[digest[:MEMORY_DIGEST_CHARS]],
+                    metadatas=[{"user_id": user_id, "timestamp": str(stale[-1][0]), "digest": True}],
+                    ids=[f"{user_id}_digest_{uuid.uuid4().hex}"]
+                )
+                collection.delete(ids=[entry_id for _, entry_id, _ in stale])
+                removed += len(stale)
+        return removed
+
+class MemoryWriter:
+    """Write-behind queue that batches Oracle memories into ChromaDB.
+
+    Memories are queued on the request path and added to the store by a
+    background task, one collection.add per partition per batch, so
+    documents are embedded together and interaction latency never includes
+    embedding time. A batch
+    is flushed once it reaches MEMORY_BATCH_SIZE or MEMORY_FLUSH_INTERVAL
+    seconds after its first memory, whichever comes first.
+    """
+
+    def __init__(self, store: MemoryStore, batch_size: int = MEMORY_BATCH_SIZE, flush_interval: float = MEMORY_FLUSH_INTERVAL):
+        self.store = store
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        """Start the background flush task on the running event loop."""
+        if self.running:
+            return
+        self.queue = asyncio.Queue(maxsize=MEMORY_QUEUE_SIZE)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Flush every queued memory, then stop the background task."""
+        if not self.running:
+            return
+        await self.queue.put(None)
+        try:
+            await asyncio.wait_for(self._task, timeout=MEMORY_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            print(f"Memory writer did not drain within {MEMORY_SHUTDOWN_TIMEOUT}s; {self.queue.qsize()} memories lost")
+            self._task.cancel()
+
+    def enqueue(self, user_id: int, text: str):
+        """Queue a memory for the next batch."""
+        memory = {
+            "user_id": user_id,
+            "id": f"{user_id}_{uuid.uuid4().hex}",
+            "document": text,
+            "metadata": {"user_id": str(user_id), "timestamp": str(time.time())}
+        }
+        if not self.running:
+            # Nothing will drain the queue (e.g. outside the app lifecycle); write through
+            self._write([memory])
+            return
+        try:
+            self.queue.put_nowait(memory)
+            MEMORY_QUEUE_DEPTH.set(self.queue.qsize())
+        except asyncio.QueueFull:
+            MEMORY_WRITES.labels(result="dropped").inc()
+            print(f"Memory queue full; dropped memory for user {user_id}")
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            first = await self.queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    memory = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if memory is None:
+                    stopping = True
+                    break
+                batch.append(memory)
+            MEMORY_QUEUE_DEPTH.set(self.queue.qsize())
+            await asyncio.to_thread(self._write, batch)
+
+        # Drain whatever was queued behind the stop sentinel
+        remaining = []
+        while not self.queue.empty():
+            memory = self.queue.get_nowait()
+            if memory is not None:
+                remaining.append(memory)
+        for start in range(0, len(remaining), self.batch_size):
+            await asyncio.to_thread(self._write, remaining[start:start + self.batch_size])
+        MEMORY_QUEUE_DEPTH.set(0)
+
+    def _write(self, batch: List[Dict]):
+        try:
+            self.store.add(batch)
+            MEMORY_FLUSH_BATCH_SIZE.observe(len(batch))
+            MEMORY_WRITES.labels(result="stored").inc(len(batch))
+        except Exception as e:
+            MEMORY_WRITES.labels(result="failed").inc(len(batch))
+            print(f"Error storing {len(batch)} memories: {e}")
+
+memory_store = MemoryStore(get_chroma_client)
+
+# Memories are written behind the request path in batches
+memory_writer = MemoryWriter(memory_store)
@@ -0,0 +1,169 @@
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Oracle semantic cache
+ORACLE_CACHE_LOOKUPS = Counter(
+    "questify_oracle_cache_lookups_total",
+    "Oracle semantic cache lookups by result (hit, miss, expired)",
+    ["result"]
+)
+ORACLE_CACHE_EVICTIONS = Counter(
+    "questify_oracle_cache_evictions_total",
+    "Oracle semantic cache entries evicted by reason (ttl, lru)",
+    ["reason"]
+)
+
+# Oracle memory write-behind queue
+MEMORY_QUEUE_DEPTH = Gauge(
+    "questify_memory_queue_depth",
+    "Oracle memories waiting to be flushed to ChromaDB"
+)
+MEMORY_FLUSH_BATCH_SIZE = Histogram(
+    "questify_memory_flush_batch_size",
+    "Number of memories written per ChromaDB flush",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+MEMORY_WRITES = Counter(
+    "questify_memory_writes_total",
+    "Oracle memories by write outcome (stored, failed, dropped)",
+    ["result"]
+)
+
+# Password hashing pool and login throttling
+PASSWORD_HASH_QUEUE_DEPTH = Gauge(
+    "questify_password_hash_pending",
+    "Password hash/verify jobs waiting for or running in the process pool"
+)
+PASSWORD_HASH_DURATION = Histogram(
+    "questify_password_hash_seconds",
+    "Time from submitting a password hash/verify job to its result, by operation",
+    ["op"]
+)
+PASSWORD_HASH_REJECTED = Counter(
+    "questify_password_hash_rejected_total",
+    "Password hash/verify jobs rejected because the pool was saturated"
+)
+LOGIN_THROTTLED = Counter(
+    "questify_login_throttled_total",
+    "Login attempts refused by the attempt limiter, by limit (account, ip)",
+    ["scope"]
+)
+
+# Guild chat delivery
+CHAT_CONNECTIONS = Gauge(
+    "questify_chat_connections",
+    "Guild chat sockets connected to this process"
+)
+CHAT_QUEUED_MESSAGES = Gauge(
+    "questify_chat_queued_messages",
+    "Chat messages waiting in per-connection send queues"
+)
+CHAT_MESSAGES_DROPPED = Counter(
+    "questify_chat_messages_dropped_total",
+    "Chat messages not delivered to a connection, by reason (queue_full, slow_consumer)",
+    ["reason"]
+)
+CHAT_DISCONNECTS = Counter(
+    "questify_chat_disconnects_total",
+    "Chat connections closed, by reason (client, slow_consumer, send_timeout, idle, error)",
+    ["reason"]
+)
+
+# Guild quest progress
+GUILD_PROGRESS_FLUSHED = Counter(
+    "questify_guild_progress_flushed_total",
+    "Guild quests whose progress counted in Redis was written to Postgres"
+)
+
+# Database connection pools (sync, async, background)
+DB_POOL_CHECKED_OUT = Gauge(
+    "questify_db_pool_checked_out",
+    "Database connections currently checked out of the pool",
+    ["pool"]
+)
+DB_POOL_CHECKOUT_SECONDS = Histogram(
+    "questify_db_pool_checkout_seconds",
+    "Time to get a connection from the pool, including waiting for one and connecting",
+    ["pool"],
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+DB_POOL_OVERFLOW = Counter(
+    "questify_db_pool_overflow_total",
+    "Connections opened beyond the pool size",
+    ["pool"]
+)
+DB_POOL_TIMEOUTS = Counter(
+    "questify_db_pool_timeouts_total",
+    "Checkouts that gave up waiting for a free connection",
+    ["pool"]
+)
+DB_REPLICA_LAG = Gauge(
+    "questify_db_replica_lag_seconds",
+    "Replay lag of each read replica at its last check (+Inf while unreachable)",
+    ["replica"]
+)
+DB_READS = Counter(
+    "questify_db_reads_total",
+    "Read-only requests by where they were sent (a replica or primary) and why (replica, recent_write, lagging, error)",
+    ["target", "reason"]
+)
+
+# HTTP requests, labelled by route template
+HTTP_REQUESTS = Counter(
+    "questify_http_requests_total",
+    "HTTP requests served, by method, route and status code",
+    ["method", "route", "status"]
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "questify_http_request_seconds",
+    "Time to serve an HTTP request, until the response body is sent",
+    ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge(
+    "questify_http_requests_in_progress",
+    "HTTP requests being served by this process",
+    ["method"]
+)
+
+# SQL statements
+DB_QUERY_SECONDS = Histogram(
+    "questify_db_query_seconds",
+    "Time to execute a single SQL statement",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+DB_REQUEST_QUERIES = Histogram(
+    "questify_db_request_queries",
+    "SQL statements executed while serving an HTTP request",
+    ["method", "route"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+)
+DB_REQUEST_QUERY_SECONDS = Histogram(
+    "questify_db_request_query_seconds",
+    "Total time spent in SQL while serving an HTTP request",
+    ["method", "route"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+
+# Leaderboard windows merged in Redis
+LEADERBOARD_CACHE_LOOKUPS = Counter(
+    "questify_leaderboard_cache_lookups_total",
+    "Merged leaderboard window lookups by timeframe and result (hit, miss)",
+    ["timeframe", "result"]
+)
+FRIEND_LEADERBOARD_LOOKUPS = Counter(
+    "questify_friend_leaderboard_lookups_total",
+    "Friends leaderboard view lookups by timeframe and result (hit, miss)",
+    ["timeframe", "result"]
+)
+
+# Oracle pipeline stages (context, memories, embed, cache_lookup, llm, llm_first_token, action, web_search, ...)
+ORACLE_STAGE_SECONDS = Histogram(
+    "questify_oracle_stage_seconds",
+    "Duration of each stage of an Oracle interaction",
+    ["stage"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+)
+
+def render_metrics():
+    """Render all registered metrics in the Prometheus text format."""
+    return generate_latest(), CONTENT_TYPE_LATEST
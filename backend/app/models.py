@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Float, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Float, Text, Index, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from datetime import datetime
@@ -16,8 +16,10 @@ class User(Base):
     level = Column(Integer, default=1)
     xp = Column(Integer, default=0)
     xp_for_next_level = Column(Integer, default=100)
+    total_xp = Column(Integer, default=0, server_default="0")  # Lifetime XP, used for rankings
     created_at = Column(DateTime, default=datetime.utcnow)
     last_interaction_mood = Column(String, default="neutral")
+    token_version = Column(Integer, default=0, server_default="0", nullable=False)  # Bumped to revoke issued tokens
     
     # Relationships
     avatar = relationship("Avatar", back_populates="user", uselist=False)
@@ -42,6 +44,29 @@ class Quest(Base):
     
     # Relationships
     user = relationship("User", back_populates="quests")
+    
+    # Quest lists are paged newest first by (created_at, id) within a user;
+    # the partial indexes serve the active and completed filters
+    __table_args__ = (
+        Index("ix_quests_user_created", "user_id", "created_at", "id"),
+        Index("ix_quests_user_active", "user_id", "created_at", "id", postgresql_where=is_completed.is_(False)),
+        Index("ix_quests_user_completed", "user_id", "created_at", "id", postgresql_where=is_completed.is_(True)),
+    )
+
+class XPEvent(Base):
+    """Append-only ledger of XP grants; rows are never updated or deleted."""
+    __tablename__ = "xp_events"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    amount = Column(Integer, nullable=False)
+    source = Column(String, nullable=False)  # quest, guild_quest, ...
+    source_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False, index=True)
+    
+    __table_args__ = (
+        Index("ix_xp_events_user_created", "user_id", "created_at"),
+    )
 
 class Avatar(Base):
     __tablename__ = "avatars"
@@ -69,6 +94,23 @@ class Friendship(Base):
     # Relationships
     user_one = relationship("User", foreign_keys=[user_one_id], back_populates="friendships_one")
     user_two = relationship("User", foreign_keys=[user_two_id], back_populates="friendships_two")
+    
+    # One row per pair of users, whichever of them asked
+    __table_args__ = (
+        Index("uq_friendships_pair", func.least(user_one_id, user_two_id), func.greatest(user_one_id, user_two_id), unique=True),
+    )
+
+class FriendEdge(Base):
+    """Accepted friendships as symmetric edges: one row per direction.
+
+    Friend lists and mutual friends are primary key range lookups on
+    (user_id, friend_id), without ORing over both columns of friendships.
+    """
+    __tablename__ = "friend_edges"
+    
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    friend_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    created_at = Column(DateTime, default=datetime.utcnow, nullable=False)
 
 class Guild(Base):
     __tablename__ = "guilds"
@@ -1,24 +1,171 @@
-import openai
-import chromadb
+from openai import AsyncOpenAI
 from tavily import TavilyClient
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.crud import create_quest, complete_quest, get_user_quests, get_user_by_id
-from app.schemas import OracleInput, OracleAction
+from app.database import run_sync
+from app.schemas import OracleInput, OracleAction, QuestCreate
+from app.semantic_cache import SemanticCache, context_fingerprint, ORACLE_CACHE_ENABLED
+from app.memory import get_chroma_client, memory_store, memory_writer
+from app.metrics import ORACLE_STAGE_SECONDS
 import os
 import json
-from typing import List, Dict, Any
+import logging
+import time
+import re
+from typing import List, Dict, Any, Awaitable, AsyncIterator, Optional, Tuple
 import asyncio
 
+logger = logging.getLogger(__name__)
+
+# Oracle call limits
+ORACLE_LLM_TIMEOUT = float(os.getenv("ORACLE_LLM_TIMEOUT", "30"))
+ORACLE_MAX_CONCURRENT_CALLS = int(os.getenv("ORACLE_MAX_CONCURRENT_CALLS", "8"))
+
 # Initialize clients
-openai.api_key = os.getenv("OPENAI_API_KEY")
+# OPENAI_BASE_URL can point at a local fake LLM server for benchmarking
+openai_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    base_url=os.getenv("OPENAI_BASE_URL") or None,
+    timeout=ORACLE_LLM_TIMEOUT,
+)
 tavily_client = TavilyClient(api_key=os.getenv("TAVILY_API_KEY"))
 
-# Initialize ChromaDB for memory
-chroma_client = chromadb.Client()
-try:
-    memory_collection = chroma_client.get_collection("user_memories")
-except:
-    memory_collection = chroma_client.create_collection("user_memories")
+def record_timings(kind: str, user_id: int, timings: Dict[str, float]):
+    """Log an interaction's stage timings and add them to the stage histograms."""
+    for stage, seconds in timings.items():
+        ORACLE_STAGE_SECONDS.labels(stage=stage).observe(seconds)
+    logger.info(
+        "Oracle %s timings for user %s: %s",
+        kind,
+        user_id,
+        ", ".join(f"{stage}={seconds * 1000:.1f}ms" for stage, seconds in timings.items())
+    )
+
+async def timed(timings: Dict[str, float], stage: str, awaitable: Awaitable):
+    """Await a stage of the pipeline and record its duration in seconds."""
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[stage] = time.perf_counter() - start
+
+# Matches an escape sequence cut off at the end of a streamed chunk
+PARTIAL_ESCAPE = re.compile(r'(?<!\\)((?:\\\\)*)\\(u[0-9a-fA-F]{0,3})?$')
+# Matches a high surrogate escape at the end of a chunk, whose low half hasn't arrived
+PARTIAL_SURROGATE = re.compile(r'(?<!\\)((?:\\\\)*)\\u[dD][89abAB][0-9a-fA-F]{2}$')
+
+class EnvelopeParser:
+    """Incrementally parse the Oracle's {"action", "data", "message"} envelope.
+
+    Tokens are fed in as they stream from the LLM. Each top-level field is
+    decoded as soon as its value is complete, and the text of the "message"
+    field is decoded as it arrives so it can be forwarded to the client.
+    Output that doesn't start with "{" is treated as a plain message.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.fields: Dict[str, Any] = {}
+        self.is_json: Optional[bool] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expecting = "key"
+        self._key: Optional[str] = None
+        self._key_start = 0
+        self._value_start: Optional[int] = None
+        self._message_span: Optional[List[Optional[int]]] = None
+        self._message_sent = 0
+
+    def feed(self, chunk: str) -> Tuple[List[str], str]:
+        """Consume a chunk; return (newly completed field names, new message text)."""
+        self.buffer += chunk
+        if self.is_json is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return [], ""
+            self.is_json = stripped.startswith("{")
+        if not self.is_json:
+            return [], chunk
+
+        completed = []
+        while self._pos < len(self.buffer):
+            i, char = self._pos, self.buffer[self._pos]
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._expecting == "key":
+                        self._key = self.buffer[self._key_start + 1:i]
+                        self._expecting = "colon"
+                    elif self._message_span and self._message_span[1] is None:
+                        self._message_span[1] = i
+                continue
+            if self._depth == 1 and self._expecting == "value" and self._value_start is None and not char.isspace():
+                self._value_start = i
+                if self._key == "message" and char == '"':
+                    self._message_span = [i + 1, None]
+            if char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expecting == "key":
+                    self._key_start = i
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed += self._finish_value(i)
+            elif self._depth == 1 and char == ":":
+                self._expecting = "value"
+                self._value_start = None
+            elif self._depth == 1 and char == ",":
+                completed += self._finish_value(i)
+                self._expecting = "key"
+
+        return completed, self._message_delta()
+
+    def _finish_value(self, end: int) -> List[str]:
+        if self._expecting != "value" or self._key is None or self._value_start is None:
+            return []
+        try:
+            self.fields[self._key] = json.loads(self.buffer[self._value_start:end])
+        except json.JSONDecodeError:
+            return []
+        return [self._key]
+
+    def _message_delta(self) -> str:
+        if not self._message_span:
+            return ""
+        start, end = self._message_span
+        raw = self.buffer[start:end if end is not None else len(self.buffer)]
+        if end is None:
+            raw = PARTIAL_ESCAPE.sub(lambda m: m.group(1), raw)
+            raw = PARTIAL_SURROGATE.sub(lambda m: m.group(1), raw)
+        try:
+            decoded = json.loads(f'"{raw}"')
+        except json.JSONDecodeError:
+            return ""
+        delta = decoded[self._message_sent:]
+        self._message_sent = len(decoded)
+        return delta
+
+    def envelope(self) -> Dict[str, Any]:
+        """Return the final envelope, falling back to a plain message."""
+        if self.is_json and "action" in self.fields:
+            return self.fields
+        try:
+            return json.loads(self.buffer)
+        except json.JSONDecodeError:
+            return {"action": "MESSAGE", "data": {}, "message": self.buffer.strip()}
+
+def sse_event(event: str, payload: Dict[str, Any]) -> str:
+    """Format a server-sent event."""
+    return f"event: {event}\ndata: {json.dumps(payload)}\n\n"
 
 class Oracle:
     def __init__(self):
@@ -45,16 +192,18 @@ Always respond with valid JSON in this format:
     },
     "message": "Your response message to the user"
 }"""
+        # Bounds the number of in-flight LLM calls per worker
+        self.llm_slots = asyncio.Semaphore(ORACLE_MAX_CONCURRENT_CALLS)
+        self.cache = SemanticCache(get_chroma_client) if ORACLE_CACHE_ENABLED else None
 
-    def get_user_context(self, db: Session, user_id: int) -> Dict[str, Any]:
+    async def get_user_context(self, db: AsyncSession, user_id: int) -> Dict[str, Any]:
         """Gather user context for the Oracle."""
-        user = get_user_by_id(db, user_id)
+        user = await db.run_sync(get_user_by_id, user_id)
         if not user:
             return {}
         
         # Get active quests
-        quests = get_user_quests(db, user_id)
-        active_quests = [q for q in quests if not q.is_completed]
+        active_quests = await db.run_sync(get_user_quests, user_id, status="active")
         
         return {
             "user": {
@@ -75,47 +224,103 @@ Always respond with valid JSON in this format:
             ]
         }
 
-    def get_user_memories(self, user_id: int, query: str, limit: int = 5) -> List[str]:
+    async def get_user_memories(self, user_id: int, query: str, limit: int = 5) -> List[str]:
         """Retrieve relevant user memories from ChromaDB."""
         try:
-            results = memory_collection.query(
-                query_texts=[query],
-                n_results=limit,
-                where={"user_id": str(user_id)}
-            )
-            return results['documents'][0] if results['documents'] else []
+            return await asyncio.to_thread(memory_store.query, user_id, query, limit)
         except Exception as e:
             print(f"Error retrieving memories: {e}")
             return []
 
     def store_memory(self, user_id: int, text: str):
-        """Store a memory in ChromaDB."""
-        try:
-            memory_collection.add(
-                documents=[text],
-                metadatas=[{"user_id": str(user_id), "timestamp": str(asyncio.get_event_loop().time())}],
-                ids=[f"{user_id}_{asyncio.get_event_loop().time()}"]
-            )
-        except Exception as e:
-            print(f"Error storing memory: {e}")
+        """Queue a memory for batched storage in ChromaDB."""
+        memory_writer.enqueue(user_id, text)
 
-    def search_web(self, query: str) -> str:
+    async def search_web(self, query: str) -> str:
         """Search the web using Tavily API."""
+        start = time.perf_counter()
         try:
-            response = tavily_client.search(query=query, search_depth="basic")
+            response = await asyncio.to_thread(tavily_client.search, query=query, search_depth="basic")
             return response.get('content', 'No information found.')
         except Exception as e:
             print(f"Error searching web: {e}")
             return "Unable to search the web at this time."
+        finally:
+            ORACLE_STAGE_SECONDS.labels(stage="web_search").observe(time.perf_counter() - start)
 
-    def interact(self, db: Session, user_id: int, input_data: OracleInput) -> OracleAction:
+    async def complete(self, prompt: str) -> str:
+        """Run a single bounded, time-limited LLM call."""
+        async with self.llm_slots:
+            response = await asyncio.wait_for(
+                openai_client.chat.completions.create(
+                    model="gpt-4",
+                    messages=[
+                        {"role": "system", "content": self.system_prompt},
+                        {"role": "user", "content": prompt}
+                    ],
+                    temperature=0.7,
+                    max_tokens=500
+                ),
+                timeout=ORACLE_LLM_TIMEOUT
+            )
+        return response.choices[0].message.content.strip()
+
+    async def interact(self, db: AsyncSession, user_id: int, input_data: OracleInput) -> OracleAction:
         """Main Oracle interaction method."""
-        # Gather context
-        context = self.get_user_context(db, user_id)
-        memories = self.get_user_memories(user_id, input_data.message)
-        
-        # Construct prompt
-        prompt = f"""
+        timings: Dict[str, float] = {}
+        try:
+            return await self._interact(db, user_id, input_data, timings)
+        finally:
+            record_timings("stage", user_id, timings)
+
+    async def embed_message(self, message: str) -> Optional[List[float]]:
+        """Embed a message for the response cache, or None if the cache is off."""
+        if self.cache is None:
+            return None
+        try:
+            return await asyncio.to_thread(self.cache.embed, message)
+        except Exception as e:
+            print(f"Error embedding message for cache: {e}")
+            return None
+
+    async def gather_context(self, db: AsyncSession, user_id: int, message: str, timings: Dict[str, float]):
+        """Fetch user context, memories and the cache embedding concurrently.
+
+        None of them depend on each other, so pre-LLM latency is the slowest
+        of the three rather than their sum. The session's connection goes back
+        to the pool once they're fetched, so it isn't held while waiting on
+        the LLM; actions that write check out a new one.
+        """
+        gathered = await timed(timings, "gather", asyncio.gather(
+            timed(timings, "context", self.get_user_context(db, user_id)),
+            timed(timings, "memories", self.get_user_memories(user_id, message)),
+            timed(timings, "embed", self.embed_message(message))
+        ))
+        await db.close()
+        return gathered
+
+    async def lookup_cache(self, user_id: int, context: Dict[str, Any], embedding: Optional[List[float]]) -> Optional[Dict[str, Any]]:
+        """Return a cached LLM envelope for a near-duplicate message, if any."""
+        if embedding is None:
+            return None
+        try:
+            return await asyncio.to_thread(self.cache.lookup, user_id, embedding, context_fingerprint(context))
+        except Exception as e:
+            print(f"Error reading Oracle cache: {e}")
+            return None
+
+    async def store_in_cache(self, user_id: int, message: str, context: Dict[str, Any], embedding: Optional[List[float]], envelope: Dict[str, Any]):
+        """Cache a freshly generated LLM envelope."""
+        if embedding is None:
+            return
+        try:
+            await asyncio.to_thread(self.cache.store, user_id, message, embedding, context_fingerprint(context), envelope)
+        except Exception as e:
+            print(f"Error writing Oracle cache: {e}")
+
+    def build_prompt(self, context: Dict[str, Any], memories: List[str], message: str) -> str:
+        """Construct the LLM prompt from the user's context and memories."""
+        return f"""
 {self.system_prompt}
 
 User Context:
@@ -129,44 +334,49 @@ Active Quests:
 Relevant Memories:
 {json.dumps(memories, indent=2)}
 
-User Message: "{input_data.message}"
+User Message: "{message}"
 
 Respond with valid JSON only:
 """
 
+    async def _interact(self, db: AsyncSession, user_id: int, input_data: OracleInput, timings: Dict[str, float]) -> OracleAction:
+        context, memories, embedding = await self.gather_context(db, user_id, input_data.message, timings)
+
         try:
-            # Get AI response
-            response = openai.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": self.system_prompt},
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
-            
-            ai_response = response.choices[0].message.content.strip()
-            
-            # Parse JSON response
-            try:
-                action_data = json.loads(ai_response)
-            except json.JSONDecodeError:
-                # Fallback to message if JSON parsing fails
-                action_data = {
-                    "action": "MESSAGE",
-                    "data": {},
-                    "message": ai_response
-                }
+            # Reuse the envelope of a near-duplicate message; its action still runs below
+            action_data = await timed(timings, "cache_lookup", self.lookup_cache(user_id, context, embedding))
+            if action_data is None:
+                # Get AI response
+                prompt = self.build_prompt(context, memories, input_data.message)
+                ai_response = await timed(timings, "llm", self.complete(prompt))
+                
+                # Parse JSON response
+                try:
+                    action_data = json.loads(ai_response)
+                    await self.store_in_cache(user_id, input_data.message, context, embedding, action_data)
+                except json.JSONDecodeError:
+                    # Fallback to message if JSON parsing fails
+                    action_data = {
+                        "action": "MESSAGE",
+                        "data": {},
+                        "message": ai_response
+                    }
             
             # Execute action
-            result = self.execute_action(db, user_id, action_data)
+            result = await timed(timings, "action", self.execute_action(db, user_id, action_data))
             
             # Store memory of this interaction
             self.store_memory(user_id, f"User: {input_data.message} | Oracle: {result.message}")
             
             return result
             
+        except asyncio.TimeoutError:
+            print(f"Oracle LLM call timed out after {ORACLE_LLM_TIMEOUT}s")
+            return OracleAction(
+                action="MESSAGE",
+                data={},
+                message="The Oracle is deep in thought. Please try again in a moment."
+            )
         except Exception as e:
             print(f"Error in Oracle interaction: {e}")
             return OracleAction(
@@ -175,7 +385,103 @@ Respond with valid JSON only:
                 message="I apologize, but I'm experiencing some difficulties. Please try again in a moment."
             )
 
-    def execute_action(self, db: Session, user_id: int, action_data: Dict[str, Any]) -> OracleAction:
+    async def interact_stream(self, db: AsyncSession, user_id: int, input_data: OracleInput) -> AsyncIterator[str]:
+        """Stream an Oracle interaction as server-sent events.
+
+        Emits "token" events with message text as the LLM generates it, an
+        "action" event as soon as the action is known, and a final "result"
+        event carrying the executed OracleAction. The action is executed as
+        soon as its data is complete, while the message is still streaming.
+        """
+        timings: Dict[str, float] = {}
+        parser = EnvelopeParser()
+        action_task: Optional[asyncio.Task] = None
+        try:
+            context, memories, embedding = await self.gather_context(db, user_id, input_data.message, timings)
+
+            envelope = await timed(timings, "cache_lookup", self.lookup_cache(user_id, context, embedding))
+            if envelope is not None:
+                yield sse_event("action", {"action": envelope.get("action", "MESSAGE")})
+                if envelope.get("message"):
+                    yield sse_event("token", {"text": envelope["message"]})
+            else:
+                prompt = self.build_prompt(context, memories, input_data.message)
+
+                start = time.perf_counter()
+                deadline = start + ORACLE_LLM_TIMEOUT
+                async with self.llm_slots:
+                    stream = await asyncio.wait_for(
+                        openai_client.chat.completions.create(
+                            model="gpt-4",
+                            messages=[
+                                {"role": "system", "content": self.system_prompt},
+                                {"role": "user", "content": prompt}
+                            ],
+                            temperature=0.7,
+                            max_tokens=500,
+                            stream=True
+                        ),
+                        timeout=ORACLE_LLM_TIMEOUT
+                    )
+                    chunks = stream.__aiter__()
+                    while True:
+                        try:
+                            chunk = await asyncio.wait_for(chunks.__anext__(), timeout=deadline - time.perf_counter())
+                        except StopAsyncIteration:
+                            break
+                        token = chunk.choices[0].delta.content if chunk.choices else None
+                        if not token:
+                            continue
+                        if "llm_first_token" not in timings:
+                            timings["llm_first_token"] = time.perf_counter() - start
+
+                        completed, text = parser.feed(token)
+                        if text:
+                            yield sse_event("token", {"text": text})
+                        if "action" in completed:
+                            yield sse_event("action", {"action": parser.fields["action"]})
+                        if action_task is None and "action" in parser.fields and "data" in parser.fields:
+                            action_task = asyncio.create_task(self.execute_action(
+                                db, user_id, {"action": parser.fields["action"], "data": parser.fields["data"]}
+                            ))
+                timings["llm"] = time.perf_counter() - start
+
+                envelope = parser.envelope()
+                if parser.is_json:
+                    await self.store_in_cache(user_id, input_data.message, context, embedding, envelope)
+
+            if action_task is None:
+                action_task = asyncio.create_task(self.execute_action(
+                    db, user_id, {"action": envelope.get("action", "MESSAGE"), "data": envelope.get("data", {})}
+                ))
+            result = await timed(timings, "action", action_task)
+            # Actions that report their own outcome override the streamed message
+            if not result.message:
+                result.message = envelope.get("message", "")
+
+            self.store_memory(user_id, f"User: {input_data.message} | Oracle: {result.message}")
+            yield sse_event("result", result.dict())
+
+        except asyncio.TimeoutError:
+            print(f"Oracle LLM stream timed out after {ORACLE_LLM_TIMEOUT}s")
+            yield sse_event("result", {
+                "action": "MESSAGE",
+                "data": {},
+                "message": "The Oracle is deep in thought. Please try again in a moment."
+            })
+        except Exception as e:
+            print(f"Error in Oracle stream: {e}")
+            yield sse_event("result", {
+                "action": "MESSAGE",
+                "data": {},
+                "message": "I apologize, but I'm experiencing some difficulties. Please try again in a moment."
+            })
+        finally:
+            if action_task is not None and not action_task.done():
+                await asyncio.wait([action_task])
+            record_timings("stream", user_id, timings)
+
+    async def execute_action(self, db: AsyncSession, user_id: int, action_data: Dict[str, Any]) -> OracleAction:
         """Execute the action specified by the AI."""
         action = action_data.get("action", "MESSAGE")
         data = action_data.get("data", {})
@@ -188,7 +494,7 @@ Respond with valid JSON only:
                     "description": data.get("description", ""),
                     "xp_value": data.get("xp_value", 10)
                 }
-                quest = create_quest(db, quest_data, user_id)
+                quest = await run_sync(db, create_quest, QuestCreate(**quest_data), user_id)
                 message = f"Quest created: {quest.title} (XP: {quest.xp_value})"
             except Exception as e:
                 message = f"Failed to create quest: {str(e)}"
@@ -197,7 +503,7 @@ Respond with valid JSON only:
             try:
                 quest_id = data.get("quest_id")
                 if quest_id:
-                    quest = complete_quest(db, quest_id, user_id)
+                    quest = await run_sync(db, complete_quest, quest_id, user_id)
                     if quest:
                         message = f"Quest completed: {quest.title}! You gained {quest.xp_value} XP!"
                     else:
@@ -211,7 +517,7 @@ Respond with valid JSON only:
             try:
                 query = data.get("query", "")
                 if query:
-                    search_result = self.search_web(query)
+                    search_result = await self.search_web(query)
                     message = f"Search results for '{query}': {search_result}"
                 else:
                     message = "No search query provided."
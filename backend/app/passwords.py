@@ -0,0 +1,73 @@
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+from app.metrics import PASSWORD_HASH_QUEUE_DEPTH, PASSWORD_HASH_DURATION, PASSWORD_HASH_REJECTED
+import asyncio
+import multiprocessing
+import os
+import time
+from typing import Optional
+
+# Password hashing
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+# bcrypt runs in its own process pool so it neither blocks the event loop nor
+# competes with request handlers for the threadpool (or the GIL)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# Jobs allowed to wait for or run in the pool before new ones are rejected
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against its hash."""
+    return pwd_context.verify(plain_password, hashed_password)
+
+def get_password_hash(password: str) -> str:
+    """Hash a password."""
+    return pwd_context.hash(password)
+
+class PasswordHasherBusy(Exception):
+    """Raised when the password hashing pool already has too many pending jobs."""
+
+class PasswordHasher:
+    """Bounded process pool for bcrypt hashing and verification."""
+
+    def __init__(self, workers: int = PASSWORD_HASH_WORKERS, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def start(self):
+        if self._pool is None:
+            # Not fork: the scheduler and Redis listener threads are already
+            # running, and a forked child can inherit a lock one of them held
+            self._pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+
+    def stop(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    async def _run(self, op: str, fn, *args):
+        if self.pending >= self.max_pending:
+            PASSWORD_HASH_REJECTED.inc()
+            raise PasswordHasherBusy()
+        self.start()
+        self.pending += 1
+        PASSWORD_HASH_QUEUE_DEPTH.set(self.pending)
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._pool, fn, *args)
+        finally:
+            self.pending -= 1
+            PASSWORD_HASH_QUEUE_DEPTH.set(self.pending)
+            PASSWORD_HASH_DURATION.labels(op=op).observe(time.perf_counter() - start)
+
+    async def hash(self, password: str) -> str:
+        """Hash a password in the pool."""
+        return await self._run("hash", get_password_hash, password)
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        """Verify a password against its hash in the pool."""
+        return await self._run("verify", verify_password, plain_password, hashed_password)
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,187 @@
+from fastapi import Depends
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.auth import get_current_user
+from app.cache import async_redis_client
+from app.database import get_async_db, pool_options, InstrumentedAsyncQueuePool
+from app.instrumentation import instrument_engine, request_stats
+from app.metrics import DB_REPLICA_LAG, DB_READS
+from app.models import User
+import asyncio
+import os
+import random
+import time
+from typing import List, Optional
+
+# Comma-separated read replica URLs (postgresql://...). Without any, every
+# read goes to the primary and none of this costs anything.
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+# Replicas further behind than this many seconds aren't read from
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", "5"))
+# Seconds between replica lag checks
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "2"))
+
+# Seconds of replay lag; 0 when the replica has replayed everything it has
+# received (an idle primary writes nothing, so its last replay time ages)
+LAG_QUERY = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+""")
+
+def last_write_key(user_id: int) -> str:
+    """Redis key holding when a user last wrote to the primary."""
+    return f"db:last_write:{user_id}"
+
+class Replica:
+    """A read replica's engine, sessions and last measured lag."""
+
+    def __init__(self, name: str, url: str):
+        self.name = name
+        self.engine = create_async_engine(
+            url.replace("postgresql://", "postgresql+asyncpg://", 1),
+            poolclass=InstrumentedAsyncQueuePool, **pool_options(name)
+        )
+        instrument_engine(self.engine.sync_engine)
+        self.sessions = async_sessionmaker(bind=self.engine, autoflush=False, expire_on_commit=False)
+        # Seconds behind the primary; None until measured, or while unreachable
+        self.lag: Optional[float] = None
+
+    async def check(self, timeout: float):
+        try:
+            async with self.engine.connect() as conn:
+                lag = await asyncio.wait_for(conn.scalar(LAG_QUERY), timeout=timeout)
+            self.lag = float(lag or 0)
+        except Exception as e:
+            if self.lag is not None:
+                print(f"Read replica {self.name} is unavailable: {e}")
+            self.lag = None
+        DB_REPLICA_LAG.labels(replica=self.name).set(self.lag if self.lag is not None else float("inf"))
+
+class ReplicaRouter:
+    """Sends reads to a replica that is caught up enough, or to the primary.
+
+    Replica lag is measured in the background. A read goes to the primary
+    when no replica is within REPLICA_MAX_LAG, or when the user wrote recently
+    enough that a replica might not have their write yet (read-your-writes).
+    Writes are recorded in Redis, so this holds across workers.
+    """
+
+    def __init__(self, urls: List[str], max_lag: float = REPLICA_MAX_LAG, check_interval: float = REPLICA_CHECK_INTERVAL):
+        self.replicas = [Replica(f"replica{i}", url) for i, url in enumerate(urls, 1)]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.replicas)
+
+    def start(self):
+        """Start measuring replica lag on the running event loop."""
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    async def _monitor(self):
+        while True:
+            await asyncio.gather(*(replica.check(self.check_interval) for replica in self.replicas))
+            await asyncio.sleep(self.check_interval)
+
+    def choose(self, since_write: Optional[float]) -> Optional[Replica]:
+        """A replica fresh enough to read from, or None for the primary.
+
+        since_write is the seconds since the user's last write, if recent.
+        Lag may have grown since it was measured, so a replica must be
+        behind by a check interval less than that.
+        """
+        candidates = [
+            replica for replica in self.replicas
+            if replica.lag is not None and replica.lag <= self.max_lag
+            and (since_write is None or replica.lag + self.check_interval < since_write)
+        ]
+        return random.choice(candidates) if candidates else None
+
+    async def route(self, user_id: int) -> Optional[Replica]:
+        """Pick where one of a user's reads should go (None for the primary)."""
+        try:
+            last_write = await async_redis_client.get(last_write_key(user_id))
+        except Exception as e:
+            # Can't tell whether a replica has the user's writes yet
+            print(f"Error reading last write time for user {user_id}: {e}")
+            DB_READS.labels(target="primary", reason="error").inc()
+            return None
+        since_write = time.time() - float(last_write) if last_write else None
+        replica = self.choose(since_write)
+        if replica is not None:
+            DB_READS.labels(target=replica.name, reason="replica").inc()
+        elif since_write is not None and any(r.lag is not None and r.lag <= self.max_lag for r in self.replicas):
+            DB_READS.labels(target="primary", reason="recent_write").inc()
+        else:
+            DB_READS.labels(target="primary", reason="lagging").inc()
+        return replica
+
+    async def remember_write(self, user_id: int):
+        """Keep a user's reads on the primary until replicas have caught up with this write."""
+        try:
+            await async_redis_client.set(
+                last_write_key(user_id), time.time(),
+                ex=int(self.max_lag + self.check_interval) + 1
+            )
+        except Exception as e:
+            print(f"Error recording last write time for user {user_id}: {e}")
+
+replica_router = ReplicaRouter(DATABASE_REPLICA_URLS)
+
+async def get_read_db(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Session for read-only routes: a replica when one is fresh enough for the user, else the primary."""
+    replica = await replica_router.route(current_user.id) if replica_router.enabled else None
+    if replica is None:
+        # The primary session is the one the user was authenticated with
+        yield db
+        return
+    async with replica.sessions() as session:
+        yield session
+
+class ReadYourWritesMiddleware:
+    """Records a user's writes before their response is sent.
+
+    Any request that commits on the primary pins that user's reads to the
+    primary until replicas have caught up, so a client can read back its
+    own changes as soon as it gets the response. Must be inside
+    MetricsMiddleware, which tracks each request's database work.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not replica_router.enabled:
+            await self.app(scope, receive, send)
+            return
+
+        remembered = False
+
+        async def send_wrapper(message):
+            nonlocal remembered
+            # Streaming routes can commit after the headers go out, so look
+            # again before the last chunk of the body
+            if message["type"] == "http.response.start" or (
+                message["type"] == "http.response.body" and not message.get("more_body", False)
+            ):
+                stats = request_stats.get()
+                if not remembered and stats is not None and stats.wrote and stats.user_id is not None:
+                    await replica_router.remember_write(stats.user_id)
+                    remembered = True
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,50 +1,28 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from sqlalchemy.orm import Session
-from app.database import SessionLocal
+from app.database import BackgroundSessionLocal
 from app.models import User
 from app.crud import get_user_by_id
-import redis
-import json
+from app.memory import memory_store
+from app import leaderboard
+from app.guild_progress import flush_progress, GUILD_PROGRESS_FLUSH_INTERVAL
+from datetime import datetime
 import os
 
-# Initialize Redis
-redis_client = redis.Redis(host='redis', port=6379, db=0, decode_responses=True)
-
 # Initialize scheduler
 scheduler = AsyncIOScheduler()
 
 def update_leaderboards():
-    """Update leaderboard cache with current user rankings."""
+    """Reconcile the Redis leaderboards with user XP and the XP ledger in Postgres."""
+    db = BackgroundSessionLocal()
     try:
-        db = SessionLocal()
-        
-        # Get top 100 users by XP
-        users = db.query(User).order_by(User.xp.desc()).limit(100).all()
-        
-        # Create leaderboard entries
-        entries = []
-        for i, user in enumerate(users, 1):
-            entries.append({
-                "user_id": user.id,
-                "adventurer_name": user.adventurer_name,
-                "level": user.level,
-                "xp": user.xp,
-                "rank": i
-            })
-        
-        # Cache for different timeframes
-        timeframes = ['daily', 'weekly', 'monthly']
-        for timeframe in timeframes:
-            cache_key = f"leaderboard:{timeframe}"
-            leaderboard_data = {
-                "entries": entries,
-                "timeframe": timeframe
-            }
-            redis_client.setex(cache_key, 3600, json.dumps(leaderboard_data))
-        
-        print(f"Updated leaderboards with {len(entries)} entries")
-        
+        count = leaderboard.rebuild(db)
+        buckets = leaderboard.rebuild_windows(db)
+        friend_sets = leaderboard.rebuild_friends(db)
+        guilds = leaderboard.rebuild_guilds(db)
+        print(f"Reconciled leaderboard with {count} users, {buckets} XP buckets, {friend_sets} friend sets and {guilds} guilds")
     except Exception as e:
         print(f"Error updating leaderboards: {e}")
     finally:
@@ -59,7 +37,7 @@ def check_double_xp_events():
 def cleanup_old_data():
     """Clean up old data and optimize database."""
     try:
-        db = SessionLocal()
+        db = BackgroundSessionLocal()
         # Add cleanup logic here
         print("Cleaned up old data")
     except Exception as e:
@@ -67,14 +45,33 @@ def cleanup_old_data():
     finally:
         db.close()
 
+def compact_memories():
+    """Apply the Oracle memory retention policy."""
+    try:
+        removed = memory_store.compact()
+        if removed is None:
+            print("Memory compaction is already running on another worker")
+        else:
+            print(f"Compacted {removed} old memories")
+    except Exception as e:
+        print(f"Error compacting memories: {e}")
+
+def flush_guild_progress():
+    """Write guild quest progress counted in Redis to Postgres."""
+    try:
+        flush_progress()
+    except Exception as e:
+        print(f"Error flushing guild quest progress: {e}")
+
 def start_scheduler():
     """Start the background job scheduler."""
-    # Update leaderboards every hour
+    # Reconcile leaderboards on startup and every hour; XP changes update them live
     scheduler.add_job(
         update_leaderboards,
         CronTrigger(minute=0),  # Every hour at minute 0
         id='update_leaderboards',
-        name='Update Leaderboards'
+        name='Update Leaderboards',
+        next_run_time=datetime.now()
     )
     
     # Check for events every day at midnight
@@ -93,10 +90,30 @@ def start_scheduler():
         name='Cleanup Old Data'
     )
     
+    # Compact old Oracle memories every day at 3 AM
+    scheduler.add_job(
+        compact_memories,
+        CronTrigger(hour=3, minute=0),
+        id='compact_memories',
+        name='Compact Oracle Memories'
+    )
+    
+    # Fold guild quest progress into Postgres every few seconds
+    scheduler.add_job(
+        flush_guild_progress,
+        IntervalTrigger(seconds=GUILD_PROGRESS_FLUSH_INTERVAL),
+        id='flush_guild_progress',
+        name='Flush Guild Quest Progress',
+        max_instances=1,
+        coalesce=True
+    )
+    
     scheduler.start()
     print("Background scheduler started")
 
 def stop_scheduler():
     """Stop the background job scheduler."""
     scheduler.shutdown()
+    # Don't leave counted progress waiting for another process's next flush
+    flush_guild_progress()
     print("Background scheduler stopped") 
\ No newline at end of file
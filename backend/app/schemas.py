@@ -1,4 +1,4 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime
 
@@ -52,6 +52,25 @@ class Quest(QuestBase):
     class Config:
         from_attributes = True
 
+# Batch quest schemas
+QUEST_BATCH_MAX = 100
+
+class QuestBatchCreate(BaseModel):
+    quests: List[QuestCreate] = Field(min_length=1, max_length=QUEST_BATCH_MAX)
+
+class QuestBatchComplete(BaseModel):
+    quest_ids: List[int] = Field(min_length=1, max_length=QUEST_BATCH_MAX)
+
+class QuestCompletionResult(BaseModel):
+    quest_id: int
+    status: str  # completed, already_completed, not_found
+    quest: Optional[Quest] = None
+
+class QuestBatchCompletion(BaseModel):
+    results: List[QuestCompletionResult]
+    xp_awarded: int
+    user: Optional[UserResponse] = None
+
 # Avatar schemas
 class AvatarBase(BaseModel):
     head_style: str = "default"
@@ -86,6 +105,23 @@ class Friendship(FriendshipBase):
     class Config:
         from_attributes = True
 
+class FriendProfile(BaseModel):
+    user_id: int
+    adventurer_name: str
+    level: int
+    total_xp: int
+    since: Optional[datetime] = None  # When the friendship was accepted
+
+class FriendFeedItem(BaseModel):
+    id: int  # XP event id
+    user_id: int
+    adventurer_name: str
+    amount: int
+    source: str
+    source_id: Optional[int] = None
+    quest_title: Optional[str] = None
+    created_at: datetime
+
 # Guild schemas
 class GuildBase(BaseModel):
     name: str
@@ -102,6 +138,28 @@ class Guild(GuildBase):
     class Config:
         from_attributes = True
 
+class GuildMember(BaseModel):
+    id: int
+    user_id: int
+    guild_id: int
+    role: str
+    joined_at: datetime
+    
+    class Config:
+        from_attributes = True
+
+# Guild chat schemas
+class ChatMessage(BaseModel):
+    id: str  # Stream id, usable as ?before= and ?last_id=
+    user_id: int
+    user: str
+    message: str
+    timestamp: datetime
+
+class ChatHistory(BaseModel):
+    messages: List[ChatMessage]
+    next_before: Optional[str] = None
+
 # Guild Quest schemas
 class GuildQuestBase(BaseModel):
     title: str
@@ -122,6 +180,15 @@ class GuildQuest(GuildQuestBase):
     class Config:
         from_attributes = True
 
+class GuildQuestProgress(BaseModel):
+    quest_id: int
+    guild_id: int
+    current_value: int
+    target_value: int
+    is_completed: bool
+    completed_at: Optional[datetime] = None
+    newly_completed: bool
+
 # Hero Pass schemas
 class HeroPassBase(BaseModel):
     season_id: int = 1
@@ -162,8 +229,25 @@ class LeaderboardEntry(BaseModel):
     adventurer_name: str
     level: int
     xp: int
+    total_xp: int = 0
+    period_xp: int = 0  # XP gained within the leaderboard's timeframe
     rank: int
 
 class Leaderboard(BaseModel):
     entries: List[LeaderboardEntry]
-    timeframe: str  # daily, weekly, monthly 
\ No newline at end of file
+    timeframe: str  # daily, weekly, monthly, alltime
+
+class LeaderboardPosition(BaseModel):
+    rank: Optional[int] = None
+    timeframe: str
+    entries: List[LeaderboardEntry] 
+
+class GuildLeaderboardEntry(BaseModel):
+    guild_id: int
+    name: str
+    total_xp: int  # Summed total XP of the guild's members
+    rank: int
+
+class GuildLeaderboard(BaseModel):
+    entries: List[GuildLeaderboardEntry]
+    guild: Optional[GuildLeaderboardEntry] = None  # The guild asked for with ?guild_id=
\ No newline at end of file
@@ -0,0 +1,135 @@
+from chromadb.utils.embedding_functions import DefaultEmbeddingFunction
+from app.metrics import ORACLE_CACHE_LOOKUPS, ORACLE_CACHE_EVICTIONS
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+# Cache configuration
+ORACLE_CACHE_ENABLED = os.getenv("ORACLE_CACHE_ENABLED", "true").lower() == "true"
+ORACLE_CACHE_MAX_DISTANCE = float(os.getenv("ORACLE_CACHE_MAX_DISTANCE", "0.08"))
+ORACLE_CACHE_USER_TTL = int(os.getenv("ORACLE_CACHE_USER_TTL", "900"))
+ORACLE_CACHE_GLOBAL_TTL = int(os.getenv("ORACLE_CACHE_GLOBAL_TTL", "86400"))
+ORACLE_CACHE_MAX_ENTRIES = int(os.getenv("ORACLE_CACHE_MAX_ENTRIES", "10000"))
+
+# Envelopes that don't depend on who asked can be shared between users. Their
+# "message" is written for the user who asked, so it is never shared; these
+# actions report their own outcome instead
+GLOBAL_ACTIONS = {"SEARCH_INTERNET"}
+
+def context_fingerprint(context: Dict[str, Any]) -> str:
+    """Fingerprint the parts of a user's context that shape the Oracle's answer."""
+    user = context.get("user", {})
+    state = {
+        "level": user.get("level"),
+        "mood": user.get("mood"),
+        "active_quests": sorted(q["id"] for q in context.get("active_quests", []))
+    }
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+class SemanticCache:
+    """Cache of Oracle LLM envelopes keyed by message embedding and user context.
+
+    Only the envelope the LLM produced is cached, never the executed result:
+    a hit is passed through Oracle.execute_action again, so actions such as
+    CREATE_QUEST still take effect on every request that uses them.
+    """
+
+    def __init__(self, get_client: Callable[[], Any], collection_name: str = "oracle_response_cache"):
+        self.embedding_function = DefaultEmbeddingFunction()
+        self.get_client = get_client
+        self.collection_name = collection_name
+        self._collection = None
+
+    @property
+    def collection(self):
+        # Opened on first use, so the Oracle starts before Chroma is reachable
+        if self._collection is None:
+            self._collection = self.get_client().get_or_create_collection(
+                self.collection_name,
+                metadata={"hnsw:space": "cosine"}
+            )
+        return self._collection
+
+    def embed(self, message: str) -> List[float]:
+        """Embed a user message."""
+        return self.embedding_function([message])[0]
+
+    def lookup(self, user_id: int, embedding: List[float], fingerprint: str) -> Optional[Dict[str, Any]]:
+        """Return the cached envelope for a near-duplicate message, if any."""
+        results = self.collection.query(
+            query_embeddings=[embedding],
+            n_results=3,
+            where={"$or": [
+                {"$and": [{"user_id": str(user_id)}, {"fingerprint": fingerprint}]},
+                {"scope": "global"}
+            ]},
+            include=["metadatas", "distances"]
+        )
+        ids = results["ids"][0] if results["ids"] else []
+        now = time.time()
+        for entry_id, metadata, distance in zip(ids, results["metadatas"][0], results["distances"][0]):
+            if distance > ORACLE_CACHE_MAX_DISTANCE:
+                break
+            ttl = ORACLE_CACHE_GLOBAL_TTL if metadata["scope"] == "global" else ORACLE_CACHE_USER_TTL
+            if now - metadata["created_at"] > ttl:
+                self.collection.delete(ids=[entry_id])
+                ORACLE_CACHE_LOOKUPS.labels(result="expired").inc()
+                ORACLE_CACHE_EVICTIONS.labels(reason="ttl").inc()
+                continue
+            self.collection.update(ids=[entry_id], metadatas=[{**metadata, "last_used": now}])
+            ORACLE_CACHE_LOOKUPS.labels(result="hit").inc()
+            envelope = json.loads(metadata["envelope"])
+            if metadata["scope"] == "global":
+                # Entries stored before messages were stripped from shared envelopes
+                envelope.pop("message", None)
+            return envelope
+
+        ORACLE_CACHE_LOOKUPS.labels(result="miss").inc()
+        return None
+
+    def store(self, user_id: int, message: str, embedding: List[float], fingerprint: str, envelope: Dict[str, Any]):
+        """Cache an LLM envelope for a message."""
+        is_global = envelope.get("action") in GLOBAL_ACTIONS
+        if is_global:
+            envelope = {key: value for key, value in envelope.items() if key != "message"}
+        now = time.time()
+        self.collection.add(
+            ids=[uuid.uuid4().hex],
+            embeddings=[embedding],
+            documents=[message],
+            metadatas=[{
+                "user_id": "*" if is_global else str(user_id),
+                "scope": "global" if is_global else "user",
+                "fingerprint": fingerprint,
+                "action": envelope.get("action", "MESSAGE"),
+                "envelope": json.dumps(envelope),
+                "created_at": now,
+                "last_used": now
+            }]
+        )
+        if self.collection.count() > ORACLE_CACHE_MAX_ENTRIES:
+            self.evict()
+
+    def evict(self):
+        """Drop expired entries, then the least recently used down to 90% capacity."""
+        entries = self.collection.get(include=["metadatas"])
+        now = time.time()
+        expired, live = [], []
+        for entry_id, metadata in zip(entries["ids"], entries["metadatas"]):
+            ttl = ORACLE_CACHE_GLOBAL_TTL if metadata["scope"] == "global" else ORACLE_CACHE_USER_TTL
+            if now - metadata["created_at"] > ttl:
+                expired.append(entry_id)
+            else:
+                live.append((metadata["last_used"], entry_id))
+
+        overflow = len(live) - int(ORACLE_CACHE_MAX_ENTRIES * 0.9)
+        least_recent = [entry_id for _, entry_id in sorted(live)[:max(0, overflow)]]
+        if expired:
+            self.collection.delete(ids=expired)
+            ORACLE_CACHE_EVICTIONS.labels(reason="ttl").inc(len(expired))
+        if least_recent:
+            self.collection.delete(ids=least_recent)
+            ORACLE_CACHE_EVICTIONS.labels(reason="lru").inc(len(least_recent))
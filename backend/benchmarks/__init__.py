@@ -0,0 +1 @@
+# Questify benchmark and load-test harnesses
@@ -0,0 +1,40 @@
+"""Quest listing served both ways, for benchmarks.api_throughput.
+
+- /sync/quests: a sync route on get_db (psycopg2). Starlette runs it in its
+  worker threadpool, as every route in main.py used to be.
+- /async/quests: an async route on get_async_db (asyncpg), calling the same
+  CRUD function through run_sync, as main.py does now.
+
+Both list a user's newest quests with crud.get_user_quests. ?delay= first
+runs SELECT pg_sleep(delay), to stand in for slower queries:
+
+    uvicorn benchmarks.db_routes_server:app --port 8200
+"""
+from fastapi import Depends, FastAPI
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.crud import get_user_quests
+from app.database import get_async_db, get_db
+
+app = FastAPI(title="Questify database route benchmark server")
+
+
+@app.get("/sync/quests")
+def sync_quests(user_id: int, limit: int = 20, delay: float = 0, db: Session = Depends(get_db)):
+    if delay:
+        db.execute(text("SELECT pg_sleep(:delay)"), {"delay": delay})
+    return {"quests": len(get_user_quests(db, user_id, limit=limit))}
+
+
+@app.get("/async/quests")
+async def async_quests(user_id: int, limit: int = 20, delay: float = 0, db: AsyncSession = Depends(get_async_db)):
+    if delay:
+        await db.execute(text("SELECT pg_sleep(:delay)"), {"delay": delay})
+    return {"quests": len(await db.run_sync(get_user_quests, user_id, limit=limit))}
+
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
@@ -0,0 +1,76 @@
+"""Local stand-in for the OpenAI chat completions API.
+
+Point the backend at it with OPENAI_BASE_URL=http://localhost:9000/v1 and run:
+
+    uvicorn benchmarks.fake_llm_server:app --port 9000
+
+FAKE_LLM_LATENCY_MS controls how long each completion takes to "generate".
+Streaming requests (stream=true) spread that latency evenly across
+FAKE_LLM_TOKEN_CHARS-sized tokens, after FAKE_LLM_FIRST_TOKEN_MS.
+"""
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+import asyncio
+import json
+import os
+import time
+import uuid
+
+FAKE_LLM_LATENCY_MS = int(os.getenv("FAKE_LLM_LATENCY_MS", "1500"))
+FAKE_LLM_FIRST_TOKEN_MS = int(os.getenv("FAKE_LLM_FIRST_TOKEN_MS", "200"))
+FAKE_LLM_TOKEN_CHARS = int(os.getenv("FAKE_LLM_TOKEN_CHARS", "4"))
+
+app = FastAPI(title="Fake LLM")
+
+CANNED_RESPONSE = {
+    "action": "MESSAGE",
+    "data": {},
+    "message": "Steady your blade, adventurer. Every small deed today is a step on the road to legend."
+}
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """Return a canned Oracle envelope after a simulated generation delay."""
+    body = await request.json()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    if body.get("stream"):
+        return StreamingResponse(stream_completion(completion_id, body.get("model", "gpt-4")), media_type="text/event-stream")
+
+    await asyncio.sleep(FAKE_LLM_LATENCY_MS / 1000)
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "gpt-4"),
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": json.dumps(CANNED_RESPONSE)},
+                "finish_reason": "stop"
+            }
+        ],
+        "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+    }
+
+async def stream_completion(completion_id: str, model: str):
+    """Yield the canned envelope as OpenAI-style chat.completion.chunk events."""
+    content = json.dumps(CANNED_RESPONSE)
+    tokens = [content[i:i + FAKE_LLM_TOKEN_CHARS] for i in range(0, len(content), FAKE_LLM_TOKEN_CHARS)]
+    token_delay = max(0, FAKE_LLM_LATENCY_MS - FAKE_LLM_FIRST_TOKEN_MS) / 1000 / len(tokens)
+
+    def chunk(delta, finish_reason=None):
+        return "data: " + json.dumps({
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }) + "\n\n"
+
+    yield chunk({"role": "assistant", "content": ""})
+    await asyncio.sleep(FAKE_LLM_FIRST_TOKEN_MS / 1000)
+    for token in tokens:
+        yield chunk({"content": token})
+        await asyncio.sleep(token_delay)
+    yield chunk({}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
@@ -0,0 +1,90 @@
+"""Load test for /oracle/interact.
+
+Fires concurrent Oracle requests while probing /health, so the effect of slow
+LLM calls on unrelated endpoints is visible. Run the backend against
+benchmarks.fake_llm_server first, then:
+
+    python -m benchmarks.oracle_load --base-url http://localhost:8000 --concurrency 50
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import uuid
+
+import httpx
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of a list of samples."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def get_token(client: httpx.AsyncClient) -> str:
+    """Register a throwaway adventurer and return a bearer token."""
+    email = f"bench-{uuid.uuid4().hex[:8]}@questify.dev"
+    password = "bench-password"
+    await client.post("/register", json={"email": email, "adventurer_name": "Bench", "password": password})
+    response = await client.post("/token", data={"username": email, "password": password})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+async def timed(coro):
+    """Await a request and return (elapsed_seconds, ok)."""
+    start = time.perf_counter()
+    try:
+        response = await coro
+        ok = response.status_code < 400
+    except httpx.HTTPError:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+async def run(base_url: str, concurrency: int, requests: int):
+    limits = httpx.Limits(max_connections=concurrency + 10)
+    async with httpx.AsyncClient(base_url=base_url, timeout=120, limits=limits) as client:
+        token = await get_token(client)
+        headers = {"Authorization": f"Bearer {token}"}
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def oracle_call():
+            async with semaphore:
+                return await timed(client.post("/oracle/interact", json={"message": "motivate me"}, headers=headers))
+
+        async def health_probe(stop: asyncio.Event, samples: list):
+            while not stop.is_set():
+                samples.append((await timed(client.get("/health")))[0])
+                await asyncio.sleep(0.1)
+
+        stop = asyncio.Event()
+        health_samples = []
+        probe = asyncio.create_task(health_probe(stop, health_samples))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(oracle_call() for _ in range(requests)))
+        elapsed = time.perf_counter() - start
+        stop.set()
+        await probe
+
+    latencies = [latency for latency, ok in results if ok]
+    errors = sum(1 for _, ok in results if not ok)
+    print(f"oracle requests:   {requests} (concurrency {concurrency}, errors {errors})")
+    print(f"throughput:        {requests / elapsed:.1f} req/s over {elapsed:.1f}s")
+    if latencies:
+        print(f"oracle latency:    p50 {percentile(latencies, 50) * 1000:.0f}ms  "
+              f"p99 {percentile(latencies, 99) * 1000:.0f}ms  mean {statistics.mean(latencies) * 1000:.0f}ms")
+    print(f"/health under load: p50 {percentile(health_samples, 50) * 1000:.0f}ms  "
+          f"p99 {percentile(health_samples, 99) * 1000:.0f}ms  ({len(health_samples)} probes)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.base_url, args.concurrency, args.requests))
@@ -0,0 +1,254 @@
+"""WebSocket load test for guild chat.
+
+Starts benchmarks.ws_chat_server in a subprocess (no database or Redis
+needed), opens N simulated chat clients spread over guild rooms, sends chat
+messages into each room and reports:
+
+- connection setup rate
+- p50/p99 latency from send to each delivery, and to the last delivery in a room
+- server memory per connection (RSS growth while connecting)
+- server CPU time per message and per delivery
+
+    python -m benchmarks.ws_chat_bench --connections 1000 --rooms 10 --messages 50
+    python -m benchmarks.ws_chat_bench --connections 10000 --rooms 100 --rate 5
+
+Latencies are measured by the clients, which all run in this process, so at
+high connection counts they include client-side scheduling delay; compare
+runs on the same machine. Server stats are read from /proc (Linux only) and
+cover the server process and its workers.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+import httpx
+import websockets
+
+from benchmarks.oracle_load import percentile
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def process_tree(pid: int):
+    """A process and all its descendants (uvicorn workers), from /proc."""
+    pids, pending = [], [pid]
+    while pending:
+        current = pending.pop()
+        pids.append(current)
+        try:
+            with open(f"/proc/{current}/task/{current}/children") as f:
+                pending.extend(int(child) for child in f.read().split())
+        except OSError:
+            pass
+    return pids
+
+
+def server_stats(pid: int):
+    """Total (RSS bytes, CPU seconds) of the server processes, or None off Linux."""
+    rss = cpu = 0
+    try:
+        for process in process_tree(pid):
+            with open(f"/proc/{process}/statm") as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+            with open(f"/proc/{process}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    except OSError:
+        return None
+    return rss, cpu
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def raise_fd_limit():
+    """Allow as many sockets as the hard limit permits (inherited by the server)."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class Stats:
+    def __init__(self):
+        self.sent_at = {}  # (room, seq) -> send time
+        self.deliveries = []  # send -> delivery latencies
+        self.last_delivery = defaultdict(float)  # (room, seq) -> latest delivery time
+        self.received = 0
+        self.disconnected = 0
+
+
+async def run_client(url: str, room: int, stats: Stats, ready: asyncio.Event, done: asyncio.Event):
+    async with websockets.connect(url, max_queue=None, ping_interval=None, open_timeout=60) as ws:
+        ready.set()
+        try:
+            while not done.is_set():
+                data = json.loads(await ws.recv())
+                if data.get("type") == "ping":
+                    await ws.send(json.dumps({"type": "pong"}))
+                    continue
+                now = time.perf_counter()
+                _, seq = data["message"].split(":")
+                key = (room, int(seq))
+                stats.deliveries.append(now - stats.sent_at[key])
+                stats.last_delivery[key] = max(stats.last_delivery[key], now)
+                stats.received += 1
+        except websockets.ConnectionClosed:
+            if not done.is_set():
+                stats.disconnected += 1
+
+
+async def connect_all(base_url: str, connections: int, rooms: int, concurrency: int, stats: Stats, done: asyncio.Event):
+    """Open the clients, returning (tasks, per-room senders, members per room, seconds taken)."""
+    gate = asyncio.Semaphore(concurrency)
+    tasks, members = [], defaultdict(int)
+
+    async def open_one(index: int):
+        room = index % rooms + 1
+        ready = asyncio.Event()
+        async with gate:
+            task = asyncio.create_task(run_client(f"{base_url}/ws/guilds/{room}/chat?user=c{index}", room, stats, ready, done))
+            tasks.append(task)
+            waiter = asyncio.create_task(ready.wait())
+            await asyncio.wait({task, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            waiter.cancel()
+            if ready.is_set():
+                members[room] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(open_one(i) for i in range(connections)))
+    elapsed = time.perf_counter() - start
+
+    senders = {}
+    for room in range(1, rooms + 1):
+        senders[room] = await websockets.connect(f"{base_url}/ws/guilds/{room}/chat?user=sender{room}", ping_interval=None)
+    return tasks, senders, members, elapsed
+
+
+async def drain(ws):
+    # Senders receive their own room's messages too; discard them
+    try:
+        async for message in ws:
+            if json.loads(message).get("type") == "ping":
+                await ws.send(json.dumps({"type": "pong"}))
+    except websockets.ConnectionClosed:
+        pass
+
+
+async def benchmark(args, base_url: str, server_pid):
+    stats, done = Stats(), asyncio.Event()
+    baseline = server_stats(server_pid) if server_pid else None
+
+    tasks, senders, members, connect_seconds = await connect_all(
+        base_url, args.connections, args.rooms, args.connect_concurrency, stats, done
+    )
+    connected = sum(members.values())
+    after_connect = server_stats(server_pid) if server_pid else None
+    drainers = [asyncio.create_task(drain(ws)) for ws in senders.values()]
+
+    # Send args.messages into every room, args.rate messages per second per room
+    expected = 0
+    send_start = time.perf_counter()
+    for seq in range(args.messages):
+        for room, ws in senders.items():
+            stats.sent_at[(room, seq)] = time.perf_counter()
+            await ws.send(json.dumps({"message": f"bench:{seq}"}))
+            expected += members[room]
+        await asyncio.sleep(max(0.0, send_start + (seq + 1) / args.rate - time.perf_counter()))
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while stats.received < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    after_send = server_stats(server_pid) if server_pid else None
+
+    done.set()
+    for ws in senders.values():
+        await ws.close()
+    for task in tasks + drainers:
+        task.cancel()
+    await asyncio.gather(*tasks, *drainers, return_exceptions=True)
+
+    fanout = [stats.last_delivery[key] - sent for key, sent in stats.sent_at.items() if key in stats.last_delivery]
+    messages = len(stats.sent_at)
+    print(f"connections:  {connected}/{args.connections} in {connect_seconds:.2f}s "
+          f"({connected / connect_seconds:.0f}/s) across {args.rooms} rooms")
+    print(f"messages:     {messages} sent, {stats.received}/{expected} deliveries, "
+          f"{stats.disconnected} clients disconnected by the server")
+    print(f"delivery:     p50 {percentile(stats.deliveries, 50) * 1000:.1f}ms  p99 {percentile(stats.deliveries, 99) * 1000:.1f}ms")
+    print(f"room fan-out: p50 {percentile(fanout, 50) * 1000:.1f}ms  p99 {percentile(fanout, 99) * 1000:.1f}ms (send to last delivery)")
+    if baseline and after_connect and after_send and connected:
+        memory = (after_connect[0] - baseline[0]) / connected
+        cpu = after_send[1] - after_connect[1]
+        print(f"server:       {memory / 1024:.1f} KiB RSS per connection, "
+              f"{cpu / messages * 1000:.2f}ms CPU per message, "
+              f"{cpu / max(stats.received, 1) * 1e6:.0f}us CPU per delivery")
+
+
+async def wait_healthy(base_url: str, timeout: float = 30):
+    deadline = time.perf_counter() + timeout
+    async with httpx.AsyncClient(base_url=base_url.replace("ws", "http", 1)) as client:
+        while True:
+            try:
+                if (await client.get("/health")).status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.perf_counter() > deadline:
+                raise RuntimeError("chat benchmark server did not start")
+            await asyncio.sleep(0.2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=50, help="messages sent into each room")
+    parser.add_argument("--rate", type=float, default=5, help="messages per second per room")
+    parser.add_argument("--connect-concurrency", type=int, default=200)
+    parser.add_argument("--drain-timeout", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers (needs --redis-url above 1)")
+    parser.add_argument("--redis-url", help="fan out through Redis instead of the in-process broker")
+    parser.add_argument("--url", help="benchmark an already running server (ws://host:port) instead of starting one")
+    args = parser.parse_args()
+
+    fd_limit = raise_fd_limit()
+    if fd_limit < 2 * args.connections + 100:
+        print(f"warning: open file limit {fd_limit} is too low for {args.connections} connections")
+    if args.workers > 1 and not args.redis_url:
+        parser.error("--workers above 1 needs --redis-url")
+
+    server = None
+    base_url = args.url
+    if not base_url:
+        port = free_port()
+        base_url = f"ws://127.0.0.1:{port}"
+        env = {**os.environ, "CHAT_SEND_QUEUE_SIZE": os.getenv("CHAT_SEND_QUEUE_SIZE", "1024")}
+        if args.redis_url:
+            env["BENCH_REDIS_URL"] = args.redis_url
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "benchmarks.ws_chat_server:app", "--port", str(port),
+             "--workers", str(args.workers), "--backlog", "8192", "--log-level", "warning"],
+            env=env
+        )
+    try:
+        asyncio.run(wait_healthy(base_url))
+        asyncio.run(benchmark(args, base_url, server.pid if server else None))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
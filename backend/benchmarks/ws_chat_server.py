@@ -0,0 +1,76 @@
+"""Guild chat server for benchmarks.ws_chat_bench.
+
+Serves the real ChatHub and chat loop (app.chat) without authentication or
+the database. Chat is fanned out through an in-process broker, so no Redis
+is needed, unless BENCH_REDIS_URL points at one (required with more than
+one worker):
+
+    uvicorn benchmarks.ws_chat_server:app --port 8100
+"""
+import asyncio
+import os
+from types import SimpleNamespace
+from typing import Optional
+
+import redis.asyncio
+from fastapi import FastAPI, WebSocket
+
+from app.chat import ChatHub, serve_chat
+
+
+class LocalPubSub:
+    """The subset of redis.asyncio.client.PubSub used by ChatHub."""
+
+    def __init__(self, broker: "LocalBroker"):
+        self.broker = broker
+        self.channels = set()
+        self.queue: asyncio.Queue = asyncio.Queue()
+        broker.subscribers.add(self)
+
+    async def subscribe(self, *channels):
+        self.channels.update(channels)
+
+    async def unsubscribe(self, *channels):
+        self.channels.difference_update(channels)
+
+    async def get_message(self, ignore_subscribe_messages: bool = False, timeout: Optional[float] = 0.0):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def close(self):
+        self.broker.subscribers.discard(self)
+
+
+class LocalBroker:
+    """In-process stand-in for Redis pub/sub, for a single worker."""
+
+    def __init__(self):
+        self.subscribers = set()
+
+    def pubsub(self, ignore_subscribe_messages: bool = False):
+        return LocalPubSub(self)
+
+    async def publish(self, channel: str, payload: str) -> int:
+        receivers = [s for s in self.subscribers if channel in s.channels]
+        for subscriber in receivers:
+            subscriber.queue.put_nowait({"type": "message", "channel": channel, "data": payload})
+        return len(receivers)
+
+
+BENCH_REDIS_URL = os.getenv("BENCH_REDIS_URL")
+broker = redis.asyncio.Redis.from_url(BENCH_REDIS_URL, decode_responses=True) if BENCH_REDIS_URL else LocalBroker()
+hub = ChatHub(redis=broker, persist=bool(BENCH_REDIS_URL))
+
+app = FastAPI(title="Questify chat benchmark server")
+
+
+@app.websocket("/ws/guilds/{guild_id}/chat")
+async def guild_chat(websocket: WebSocket, guild_id: int, user: str = "bench"):
+    await serve_chat(hub, websocket, guild_id, SimpleNamespace(id=0, adventurer_name=user))
+
+
+@app.get("/health")
+def health():
+    return {"status": "ok", "rooms": len(hub.rooms), "connections": sum(len(room) for room in hub.rooms.values())}
@@ -1,19 +1,28 @@
-from fastapi import FastAPI, Depends, HTTPException, status, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Depends, HTTPException, Request, status, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from datetime import timedelta
-import redis
+from datetime import datetime, timedelta
 import json
-from typing import List
+from typing import List, Optional
 
-from app.database import get_db, create_tables
-from app.auth import authenticate_user, create_access_token, get_current_user, ACCESS_TOKEN_EXPIRE_MINUTES
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.database import get_async_db, create_tables, run_sync, AsyncSessionLocal
+from app.auth import (
+    create_user_access_token, get_current_user, user_from_token, revoke_user_tokens, start_auth_invalidation, stop_auth_invalidation,
+    login_retry_after, record_login_failure, clear_login_failures, ACCESS_TOKEN_EXPIRE_MINUTES
+)
+from app.passwords import password_hasher, PasswordHasherBusy
 from app.crud import *
 from app.schemas import *
-from app.oracle import Oracle
+from app.oracle import Oracle, memory_writer
+from app.chat import chat_hub, serve_chat, STREAM_ID
 from app.models import User
 from app.scheduler import start_scheduler, stop_scheduler
+from app.metrics import render_metrics
+from app.instrumentation import MetricsMiddleware, note_user
+from app.replicas import replica_router, get_read_db, ReadYourWritesMiddleware
+from app import crud, guild_progress, leaderboard
 
 # Initialize FastAPI app
 app = FastAPI(title="Questify API", version="1.0.0")
@@ -25,58 +34,53 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# Initialize Redis for caching
-redis_client = redis.Redis(host='redis', port=6379, db=0, decode_responses=True)
+# Pin a user's reads to the primary after they write (runs inside MetricsMiddleware)
+app.add_middleware(ReadYourWritesMiddleware)
+
+# Record latency and database work for every route
+app.add_middleware(MetricsMiddleware)
 
 # Initialize Oracle
 oracle = Oracle()
 
-# WebSocket connection manager
-class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
-
-    async def connect(self, websocket: WebSocket):
-        await websocket.accept()
-        self.active_connections.append(websocket)
-
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-
-    async def send_personal_message(self, message: str, websocket: WebSocket):
-        await websocket.send_text(message)
-
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except:
-                pass
-
-manager = ConnectionManager()
-
 # Startup event
 @app.on_event("startup")
 async def startup_event():
     create_tables()
     start_scheduler()
+    start_auth_invalidation()
+    password_hasher.start()
+    memory_writer.start()
+    replica_router.start()
 
 # Shutdown event
 @app.on_event("shutdown")
 async def shutdown_event():
     stop_scheduler()
+    stop_auth_invalidation()
+    password_hasher.stop()
+    await chat_hub.close()
+    await replica_router.stop()
+    # Flush memories still queued for ChromaDB
+    await memory_writer.stop()
 
 # Authentication endpoints
 @app.post("/register", response_model=UserResponse)
-def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Register a new user."""
-    db_user = get_user_by_email(db, user.email)
+    db_user = await db.run_sync(get_user_by_email, user.email)
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
     
-    user = create_user(db, user)
+    try:
+        password_hash = await password_hasher.hash(user.password)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins in progress, try again shortly")
+    user = await run_sync(db, create_user, user, password_hash)
+    note_user(user.id)
     return UserResponse(
         id=user.id,
         adventurer_name=user.adventurer_name,
@@ -87,188 +91,354 @@ def register(user: UserCreate, db: Session = Depends(get_db)):
     )
 
 @app.post("/token", response_model=Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
     """Login and get access token."""
-    user = authenticate_user(db, form_data.username, form_data.password)
-    if not user:
+    client_ip = request.client.host if request.client else "unknown"
+    retry_after = await login_retry_after(form_data.username, client_ip)
+    if retry_after is not None:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many failed login attempts",
+            headers={"Retry-After": str(retry_after)},
+        )
+    
+    user = await db.run_sync(get_user_by_email, form_data.username)
+    try:
+        verified = user is not None and await password_hasher.verify(form_data.password, user.password_hash)
+    except PasswordHasherBusy:
+        raise HTTPException(status_code=503, detail="Too many sign-ins in progress, try again shortly")
+    if not verified:
+        await record_login_failure(form_data.username, client_ip)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    await clear_login_failures(form_data.username)
     
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.email}, expires_delta=access_token_expires
-    )
+    access_token = create_user_access_token(user, expires_delta=access_token_expires)
     return {"access_token": access_token, "token_type": "bearer"}
 
+@app.post("/token/revoke")
+async def revoke_tokens(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Revoke every access token issued to the current user."""
+    await run_sync(db, revoke_user_tokens, current_user.id)
+    return {"message": "Tokens revoked"}
+
 @app.get("/me", response_model=UserResponse)
-def get_current_user_info(current_user: User = Depends(get_current_user)):
+async def get_current_user_info(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
     """Get current user information."""
+    # The authenticated user may come from the auth cache; report live progress
+    user = await db.run_sync(get_user_by_id, current_user.id)
     return UserResponse(
-        id=current_user.id,
-        adventurer_name=current_user.adventurer_name,
-        level=current_user.level,
-        xp=current_user.xp,
-        xp_for_next_level=current_user.xp_for_next_level,
-        last_interaction_mood=current_user.last_interaction_mood
+        id=user.id,
+        adventurer_name=user.adventurer_name,
+        level=user.level,
+        xp=user.xp,
+        xp_for_next_level=user.xp_for_next_level,
+        last_interaction_mood=user.last_interaction_mood
     )
 
 # Quest endpoints
 @app.post("/quests", response_model=Quest)
-def create_user_quest(quest: QuestCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_user_quest(quest: QuestCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Create a new quest for the current user."""
-    return create_quest(db, quest, current_user.id)
+    return await db.run_sync(create_quest, quest, current_user.id)
 
 @app.get("/quests", response_model=List[Quest])
-def get_quests(skip: int = 0, limit: int = 100, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Get all quests for the current user."""
-    return get_user_quests(db, current_user.id, skip=skip, limit=limit)
+async def get_quests(response: Response, skip: int = 0, limit: int = 100, cursor: Optional[str] = None, status: Optional[str] = None, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Get the current user's quests, newest first.
+
+    When there are more quests, the X-Next-Cursor header holds the cursor to
+    pass for the next page. `status` filters to active or completed quests.
+    """
+    if status not in (None, "active", "completed"):
+        raise HTTPException(status_code=400, detail="status must be 'active' or 'completed'")
+    limit = max(1, min(limit, 100))
+    try:
+        quests = await db.run_sync(get_user_quests, current_user.id, skip=skip, limit=limit + 1, cursor=cursor, status=status)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(quests) > limit:
+        quests = quests[:limit]
+        response.headers["X-Next-Cursor"] = encode_quest_cursor(quests[-1])
+    return quests
 
 @app.post("/quests/{quest_id}/complete", response_model=Quest)
-def complete_user_quest(quest_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def complete_user_quest(quest_id: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Complete a quest."""
-    quest = complete_quest(db, quest_id, current_user.id)
+    quest = await run_sync(db, complete_quest, quest_id, current_user.id)
     if not quest:
         raise HTTPException(status_code=404, detail="Quest not found or already completed")
     return quest
 
+@app.post("/quests/batch", response_model=List[Quest])
+async def create_user_quests_batch(batch: QuestBatchCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Create several quests for the current user in one transaction."""
+    return await db.run_sync(create_quests, batch.quests, current_user.id)
+
+@app.post("/quests/complete-batch", response_model=QuestBatchCompletion)
+async def complete_user_quests_batch(batch: QuestBatchComplete, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Complete several quests in one transaction, awarding their XP together."""
+    completed, already_completed, user = await run_sync(db, complete_quests, batch.quest_ids, current_user.id)
+    results = []
+    for quest_id in dict.fromkeys(batch.quest_ids):
+        if quest_id in completed:
+            results.append(QuestCompletionResult(quest_id=quest_id, status="completed", quest=completed[quest_id]))
+        elif quest_id in already_completed:
+            results.append(QuestCompletionResult(quest_id=quest_id, status="already_completed"))
+        else:
+            results.append(QuestCompletionResult(quest_id=quest_id, status="not_found"))
+    return QuestBatchCompletion(
+        results=results,
+        xp_awarded=sum(quest.xp_value for quest in completed.values()),
+        user=UserResponse(
+            id=user.id,
+            adventurer_name=user.adventurer_name,
+            level=user.level,
+            xp=user.xp,
+            xp_for_next_level=user.xp_for_next_level,
+            last_interaction_mood=user.last_interaction_mood
+        ) if user else None
+    )
+
 # Oracle endpoint
 @app.post("/oracle/interact", response_model=OracleAction)
-def interact_with_oracle(input_data: OracleInput, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def interact_with_oracle(input_data: OracleInput, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Interact with The Oracle AI."""
-    return oracle.interact(db, current_user.id, input_data)
+    return await oracle.interact(db, current_user.id, input_data)
+
+@app.post("/oracle/interact/stream")
+async def stream_oracle_interaction(input_data: OracleInput, current_user: User = Depends(get_current_user)):
+    """Interact with The Oracle AI, streaming the response as server-sent events."""
+    user_id = current_user.id
+
+    async def events():
+        # The session must outlive the handler, so it is owned by the stream
+        async with AsyncSessionLocal() as db:
+            async for event in oracle.interact_stream(db, user_id, input_data):
+                yield event
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 # Avatar endpoints
 @app.post("/avatar", response_model=Avatar)
-def create_user_avatar(avatar: AvatarCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_user_avatar(avatar: AvatarCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Create or update user avatar."""
-    return create_avatar(db, avatar, current_user.id)
+    return await db.run_sync(create_avatar, avatar, current_user.id)
 
 @app.get("/avatar", response_model=Avatar)
-def get_user_avatar(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_user_avatar(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Get user avatar."""
-    avatar = get_user_avatar(db, current_user.id)
+    avatar = await db.run_sync(crud.get_user_avatar, current_user.id)
     if not avatar:
         raise HTTPException(status_code=404, detail="Avatar not found")
     return avatar
 
 # Friendship endpoints
 @app.post("/friendships", response_model=Friendship)
-def create_friendship_request(friendship: FriendshipCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_friendship_request(friendship: FriendshipCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Create a friendship request."""
-    return create_friendship_request(db, current_user.id, friendship.user_two_id)
+    friendship = await db.run_sync(crud.create_friendship_request, current_user.id, friendship.user_two_id)
+    if not friendship:
+        raise HTTPException(status_code=400, detail="You can't befriend yourself")
+    return friendship
 
 @app.post("/friendships/{friendship_id}/accept", response_model=Friendship)
-def accept_friendship_request(friendship_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def accept_friendship_request(friendship_id: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Accept a friendship request."""
-    friendship = accept_friendship(db, friendship_id, current_user.id)
+    friendship = await run_sync(db, accept_friendship, friendship_id, current_user.id)
     if not friendship:
         raise HTTPException(status_code=404, detail="Friendship request not found")
     return friendship
 
 @app.get("/friendships", response_model=List[Friendship])
-def get_friendships(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_friendships(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
     """Get user friendships."""
-    return get_user_friendships(db, current_user.id)
+    return await db.run_sync(get_user_friendships, current_user.id)
+
+@app.get("/friends", response_model=List[FriendProfile])
+async def get_friend_list(limit: int = 100, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Get the current user's friends, most recent first."""
+    rows = await db.run_sync(get_friends, current_user.id, max(1, min(limit, 500)))
+    return [
+        FriendProfile(user_id=friend.id, adventurer_name=friend.adventurer_name, level=friend.level,
+                      total_xp=friend.total_xp or 0, since=since)
+        for friend, since in rows
+    ]
+
+@app.get("/friends/mutual/{user_id}", response_model=List[FriendProfile])
+async def get_mutual_friend_list(user_id: int, limit: int = 100, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Get the friends the current user has in common with another adventurer."""
+    friends = await db.run_sync(get_mutual_friends, current_user.id, user_id, max(1, min(limit, 500)))
+    return [
+        FriendProfile(user_id=friend.id, adventurer_name=friend.adventurer_name, level=friend.level, total_xp=friend.total_xp or 0)
+        for friend in friends
+    ]
+
+@app.get("/friends/feed", response_model=List[FriendFeedItem])
+async def get_friends_feed(response: Response, cursor: Optional[str] = None, limit: int = 50, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Get friends' recent activity, newest first.
+
+    When there are more items, the X-Next-Cursor header holds the cursor to
+    pass for the next page.
+    """
+    limit = max(1, min(limit, 100))
+    try:
+        rows = await db.run_sync(get_friend_feed, current_user.id, cursor, limit + 1)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_feed_cursor(rows[-1])
+    return [
+        FriendFeedItem(id=row.id, user_id=row.user_id, adventurer_name=row.adventurer_name, amount=row.amount,
+                       source=row.source, source_id=row.source_id, quest_title=row.title, created_at=row.created_at)
+        for row in rows
+    ]
 
 # Guild endpoints
 @app.post("/guilds", response_model=Guild)
-def create_guild(guild: GuildCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_guild(guild: GuildCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Create a new guild."""
-    return create_guild(db, guild, current_user.id)
+    return await run_sync(db, crud.create_guild, guild, current_user.id)
 
 @app.get("/guilds/me", response_model=Guild)
-def get_user_guild(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def get_user_guild(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Get the guild that the current user belongs to."""
-    guild = get_user_guild(db, current_user.id)
+    guild = await db.run_sync(crud.get_user_guild, current_user.id)
     if not guild:
         raise HTTPException(status_code=404, detail="User not in a guild")
     return guild
 
 @app.post("/guilds/{guild_id}/members", response_model=GuildMember)
-def add_member_to_guild(guild_id: int, user_id: int, role: str = "member", current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def add_member_to_guild(guild_id: int, user_id: int, role: str = "member", current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Add a member to a guild."""
-    return add_guild_member(db, guild_id, user_id, role)
+    return await run_sync(db, add_guild_member, guild_id, user_id, role)
 
 # Guild Quest endpoints
 @app.post("/guilds/{guild_id}/quests", response_model=GuildQuest)
-def create_guild_quest(guild_id: int, quest: GuildQuestCreate, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
+async def create_guild_quest(guild_id: int, quest: GuildQuestCreate, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
     """Create a new guild quest."""
-    return create_guild_quest(db, quest, guild_id)
+    return await db.run_sync(crud.create_guild_quest, quest, guild_id)
 
 @app.get("/guilds/{guild_id}/quests", response_model=List[GuildQuest])
-def get_guild_quests(guild_id: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Get all quests for a guild."""
-    return get_guild_quests(db, guild_id)
-
-@app.post("/guild-quests/{quest_id}/progress")
-def update_guild_quest_progress(quest_id: int, progress: int, current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Update guild quest progress."""
-    quest = update_guild_quest_progress(db, quest_id, progress)
+async def get_guild_quests(guild_id: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Get all quests for a guild, including progress not yet written to the database."""
+    quests = await db.run_sync(crud.get_guild_quests, guild_id)
+    return await guild_progress.with_live_progress(quests)
+
+@app.post("/guild-quests/{quest_id}/progress", response_model=GuildQuestProgress)
+async def update_guild_quest_progress(quest_id: int, progress: int, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Add progress to a guild quest. Completion is announced in the guild's chat."""
+    if progress <= 0:
+        raise HTTPException(status_code=400, detail="progress must be positive")
+    try:
+        quest = await guild_progress.add_progress(db, quest_id, progress)
+    except guild_progress.GuildProgressUnavailable:
+        raise HTTPException(status_code=503, detail="Guild quest progress is unavailable, try again shortly")
     if not quest:
         raise HTTPException(status_code=404, detail="Guild quest not found")
-    return {"message": "Progress updated", "quest": quest}
+    return quest
 
-# Leaderboard endpoint
+# Leaderboard endpoints
 @app.get("/leaderboard", response_model=Leaderboard)
-def get_leaderboard(timeframe: str = "weekly", limit: int = 100, db: Session = Depends(get_db)):
+def get_leaderboard(timeframe: str = "weekly", limit: int = 100):
     """Get leaderboard data."""
-    # Try to get from cache first
-    cache_key = f"leaderboard:{timeframe}"
-    cached_data = redis_client.get(cache_key)
-    
-    if cached_data:
-        return json.loads(cached_data)
-    
-    # If not in cache, calculate from database
-    users = db.query(User).order_by(User.xp.desc()).limit(limit).all()
-    
-    entries = []
-    for i, user in enumerate(users, 1):
-        entries.append(LeaderboardEntry(
-            user_id=user.id,
-            adventurer_name=user.adventurer_name,
-            level=user.level,
-            xp=user.xp,
-            rank=i
-        ))
-    
-    leaderboard = Leaderboard(entries=entries, timeframe=timeframe)
-    
-    # Cache the result for 1 hour
-    redis_client.setex(cache_key, 3600, json.dumps(leaderboard.dict()))
-    
-    return leaderboard
+    if timeframe not in leaderboard.TIMEFRAMES:
+        raise HTTPException(status_code=400, detail=f"timeframe must be one of {', '.join(leaderboard.TIMEFRAMES)}")
+    return Leaderboard(entries=leaderboard.get_top(max(1, min(limit, 100)), timeframe), timeframe=timeframe)
+
+@app.get("/leaderboard/me", response_model=LeaderboardPosition)
+def get_leaderboard_position(timeframe: str = "alltime", radius: int = 5, current_user: User = Depends(get_current_user)):
+    """Get the current user's rank and the adventurers ranked around them."""
+    if timeframe not in leaderboard.TIMEFRAMES:
+        raise HTTPException(status_code=400, detail=f"timeframe must be one of {', '.join(leaderboard.TIMEFRAMES)}")
+    entries = leaderboard.get_around(current_user.id, max(0, min(radius, 25)), timeframe)
+    me = next((entry for entry in entries if entry["user_id"] == current_user.id), None)
+    return LeaderboardPosition(rank=me["rank"] if me else None, timeframe=timeframe, entries=entries)
+
+@app.get("/leaderboard/friends", response_model=LeaderboardPosition)
+async def get_friends_leaderboard(timeframe: str = "alltime", limit: int = 100, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_read_db)):
+    """Get the current user's rank among their friends and the top of their friends leaderboard."""
+    if timeframe not in leaderboard.TIMEFRAMES:
+        raise HTTPException(status_code=400, detail=f"timeframe must be one of {', '.join(leaderboard.TIMEFRAMES)}")
+    rank, entries = await leaderboard.get_friends_position(db, current_user.id, max(1, min(limit, 100)), timeframe)
+    return LeaderboardPosition(rank=rank, timeframe=timeframe, entries=entries)
+
+@app.get("/guilds/leaderboard", response_model=GuildLeaderboard)
+def get_guild_leaderboard(limit: int = 100, guild_id: Optional[int] = None):
+    """Get the guilds with the most member XP, and optionally one guild's rank."""
+    guild = leaderboard.get_guild_entry(guild_id) if guild_id is not None else None
+    return GuildLeaderboard(entries=leaderboard.get_guild_top(max(1, min(limit, 100))), guild=guild)
 
 # Hero Pass endpoints
 @app.get("/hero-pass", response_model=HeroPass)
-def get_hero_pass(current_user: User = Depends(get_current_user), db: Session = Depends(get_db)):
-    """Get user's hero pass."""
-    hero_pass = db.query(HeroPass).filter(HeroPass.user_id == current_user.id).first()
-    if not hero_pass:
-        hero_pass = create_hero_pass(db, current_user.id)
-    return hero_pass
-
-# WebSocket endpoint for guild chat
+async def get_hero_pass(current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Get user's hero pass, creating it on first use."""
+    return await db.run_sync(create_hero_pass, current_user.id)
+
+# WebSocket endpoints for guild chat
+async def run_guild_chat(websocket: WebSocket, token: str, guild_id: Optional[int], last_id: Optional[str]):
+    async with AsyncSessionLocal() as db:
+        user = await db.run_sync(user_from_token, token)
+        if user is not None and guild_id is None:
+            guild = await db.run_sync(crud.get_user_guild, user.id)
+            guild_id = guild.id if guild else None
+        allowed = user is not None and guild_id is not None and await db.run_sync(is_guild_member, guild_id, user.id)
+    if not allowed:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+
+    if last_id and not STREAM_ID.match(last_id):
+        last_id = None
+    await serve_chat(chat_hub, websocket, guild_id, user, last_id)
+
+@app.websocket("/ws/guilds/{guild_id}/chat")
+async def websocket_guild_chat_room(websocket: WebSocket, guild_id: int, token: str, last_id: Optional[str] = None):
+    """Chat in a guild's room; the access token is passed as ?token=.
+
+    Pass the id of the last message seen as ?last_id= to be sent the ones missed since.
+    """
+    await run_guild_chat(websocket, token, guild_id, last_id)
+
 @app.websocket("/ws/guild-chat")
-async def websocket_guild_chat(websocket: WebSocket):
-    await manager.connect(websocket)
-    try:
-        while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
-            await manager.broadcast(json.dumps(message))
-    except WebSocketDisconnect:
-        manager.disconnect(websocket)
+async def websocket_guild_chat(websocket: WebSocket, token: str, last_id: Optional[str] = None):
+    """Chat in the current user's guild room."""
+    await run_guild_chat(websocket, token, None, last_id)
+
+@app.get("/guilds/{guild_id}/chat/history", response_model=ChatHistory)
+async def get_guild_chat_history(guild_id: int, before: Optional[str] = None, limit: int = 50, current_user: User = Depends(get_current_user), db: AsyncSession = Depends(get_async_db)):
+    """Get a page of a guild's recent chat, oldest first.
+
+    Pass the page's next_before as ?before= for the page before it.
+    """
+    if not await db.run_sync(is_guild_member, guild_id, current_user.id):
+        raise HTTPException(status_code=403, detail="Not a member of this guild")
+    if before and not STREAM_ID.match(before):
+        raise HTTPException(status_code=400, detail="Invalid message id")
+    limit = max(1, min(limit, 200))
+    messages = await chat_hub.history(guild_id, before, limit)
+    return ChatHistory(messages=messages, next_before=messages[0]["id"] if len(messages) == limit else None)
 
 # Health check endpoint
 @app.get("/health")
-def health_check():
+async def health_check():
     """Health check endpoint."""
     return {"status": "healthy", "message": "Questify API is running"}
 
+# Metrics endpoint
+@app.get("/metrics")
+async def metrics():
+    """Expose Prometheus metrics."""
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -133,7 +133,7 @@ const GuildHall = () => {
   }
 
   const setupWebSocket = () => {
-    const wsUrl = API_BASE_URL.replace('http', 'ws') + '/ws/guild-chat'
+    const wsUrl = API_BASE_URL.replace('http', 'ws') + `/ws/guild-chat?token=${encodeURIComponent(token ?? '')}`
     const websocket = new WebSocket(wsUrl)
     
     websocket.onopen = () => {
@@ -142,8 +142,19 @@ const GuildHall = () => {
     
     websocket.onmessage = (event) => {
       const data = JSON.parse(event.data)
+      if (data.type === 'ping') {
+        websocket.send(JSON.stringify({ type: 'pong' }))
+        return
+      }
+      if (data.type === 'guild_quest_completed') {
+        setQuests(prev => prev.map(quest => quest.id === data.quest_id
+          ? { ...quest, current_value: data.current_value, is_completed: true }
+          : quest))
+        return
+      }
+      if (data.type !== 'message') return
       setChatMessages(prev => [...prev, {
-        id: Date.now().toString(),
+        id: data.id ?? Date.now().toString(),
         user: data.user || 'Unknown',
         message: data.message,
         timestamp: new Date()